@@ -0,0 +1,152 @@
+import json
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F, Q, DecimalField, ExpressionWrapper, Value
+from django.db.models.functions import Round
+from rest_framework import serializers
+from .models import Product, OrderLog, bump_collection_version, record_product_changes
+from .stock import record_stock_movements
+
+PRICE_FIELDS = ('selling_price', 'buying_price')
+# Largest values the columns can hold: DecimalField(max_digits=10, decimal_places=2) and a 32-bit unsigned int
+MAX_VALUES = {
+    'selling_price': Decimal('99999999.99'),
+    'buying_price': Decimal('99999999.99'),
+    'stock': 2147483647,
+}
+PREVIEW_ROWS = 50
+CENT = Decimal('0.01')
+
+
+class BulkAdjustmentSerializer(serializers.Serializer):
+    """
+    Which products to change and how.
+
+    Exactly one of `category`, `supplier` or `ids` picks the products. `field` is
+    the column to change; prices take a `percent` or an `amount` change, stock only
+    an `amount` (a delta).
+    """
+    category = serializers.IntegerField(required=False)
+    supplier = serializers.IntegerField(required=False)
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False, max_length=10000)
+    field = serializers.ChoiceField(choices=PRICE_FIELDS + ('stock',))
+    mode = serializers.ChoiceField(choices=('percent', 'amount'))
+    value = serializers.DecimalField(max_digits=12, decimal_places=2)
+    dry_run = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, data):
+        filters = [name for name in ('category', 'supplier', 'ids') if name in data]
+        if len(filters) != 1:
+            raise serializers.ValidationError("Give exactly one of 'category', 'supplier' or 'ids'.")
+        if data['field'] == 'stock':
+            if data['mode'] != 'amount':
+                raise serializers.ValidationError({'mode': ["Stock can only be changed by an amount."]})
+            if data['value'] != data['value'].to_integral_value():
+                raise serializers.ValidationError({'value': ["A stock change must be a whole number."]})
+        elif data['mode'] == 'percent' and data['value'] <= -100:
+            raise serializers.ValidationError({'value': ["A price cannot drop by 100% or more."]})
+        return data
+
+
+def adjustment_filter(data):
+    if 'category' in data:
+        return Q(category_id=data['category'])
+    if 'supplier' in data:
+        return Q(supplier_id=data['supplier'])
+    return Q(pk__in=data['ids'])
+
+
+def adjusted_value(data):
+    """Database expression for the new value of the adjusted column."""
+    field = data['field']
+    if field == 'stock':
+        delta = int(data['value'])
+        # Stock is unsigned on MySQL, so never add a negative number to it
+        return F('stock') + delta if delta >= 0 else F('stock') - abs(delta)
+    if data['mode'] == 'percent':
+        factor = 1 + data['value'] / 100
+        return Round(
+            ExpressionWrapper(F(field) * Value(factor), output_field=DecimalField(max_digits=20, decimal_places=6)),
+            2,
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        )
+    return ExpressionWrapper(F(field) + Value(data['value']), output_field=DecimalField(max_digits=10, decimal_places=2))
+
+
+def out_of_range(data):
+    """Condition matching the products whose new value the column cannot hold."""
+    field = data['field']
+    if field == 'stock':
+        # Compared against the delta, because computing a negative unsigned value fails on MySQL
+        delta = int(data['value'])
+        return Q(stock__lt=-delta) if delta < 0 else Q(stock__gt=MAX_VALUES['stock'] - delta)
+    return Q(new_value__lt=0) | Q(new_value__gt=MAX_VALUES[field])
+
+
+def preview_rows(queryset, field):
+    rows = list(queryset.order_by('id').values('id', 'name', field, 'new_value')[:PREVIEW_ROWS])
+    if field in PRICE_FIELDS:
+        for row in rows:
+            row['new_value'] = Decimal(row['new_value']).quantize(CENT)
+    return rows
+
+
+def adjustment_description(data):
+    target = {name: data[name] for name in ('category', 'supplier', 'ids') if name in data}
+    value = int(data['value']) if data['field'] == 'stock' else data['value']
+    change = f"{value:+}{'%' if data['mode'] == 'percent' else ''}"
+    return json.dumps({'filter': target, 'field': data['field'], 'change': change})
+
+
+def bulk_adjust_products(data, user_name):
+    """
+    Apply a validated BulkAdjustmentSerializer payload as one UPDATE statement.
+
+    The matching rows are locked, checked in the database for values the column
+    cannot hold (negative stock or prices, prices past the column's precision) and
+    then changed together, or not at all. Products without a buying price are left
+    alone when buying prices are adjusted. A dry run reports the same counts and a
+    preview of the first rows without writing anything. A real run writes a single
+    OrderLog entry for the whole batch; a stock change also enters every product's
+    delta in the stock ledger.
+    """
+    field = data['field']
+    products = Product.objects.filter(adjustment_filter(data)).exclude(**{f'{field}__isnull': True})
+    new_value = adjusted_value(data)
+
+    with transaction.atomic():
+        ids = list(products.select_for_update().order_by('id').values_list('id', flat=True))
+        changed = products.annotate(new_value=new_value)
+        if field == 'stock':
+            invalid = products.filter(out_of_range(data)).values('id', 'name', field)
+        else:
+            invalid = changed.filter(out_of_range(data)).values('id', 'name', field, 'new_value')
+        result = {
+            'matched': len(ids),
+            'field': field,
+            'invalid': list(invalid.order_by('id')[:PREVIEW_ROWS]),
+        }
+        if result['invalid']:
+            return result, False
+
+        if data['dry_run']:
+            result['preview'] = preview_rows(changed, field)
+            return result, True
+
+        result['updated'] = products.update(**{field: new_value})
+        log = OrderLog.objects.create(
+            user=user_name,
+            action='Update',
+            model_name='Product',
+            product_name=f"Bulk adjustment of {result['updated']} products",
+            quantity=result['updated'],
+            changes_on_update=adjustment_description(data),
+        )
+        if field == 'stock':
+            record_stock_movements(dict.fromkeys(ids, int(data['value'])), 'adjustment', 'order_log', log.pk, user_name)
+        # Queryset updates send no signals, so journal the change and bump the list version here
+        record_product_changes(ids)
+        if field in PRICE_FIELDS:
+            # Order lines embed the product's price
+            bump_collection_version('orders')
+    return result, True
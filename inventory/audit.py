@@ -0,0 +1,110 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from .models import AuditOutboxEvent, OrderLog, Report
+
+
+def outbox_enabled():
+    return settings.ORDER_AUDIT_MODE == 'outbox'
+
+
+def enqueue(kind, payload):
+    AuditOutboxEvent.objects.create(kind=kind, payload=payload)
+
+
+def order_created_payload(order, customer, lines):
+    """
+    One compact event for a whole checkout.
+
+    `lines` holds (product, quantity, price) per order item; only the values the log
+    and report rows need are kept.
+    """
+    return {
+        'order_id': order.id,
+        'user': order.user,
+        # isoformat() keeps the microseconds the JSON encoder would drop
+        'order_date': order.order_date.isoformat(),
+        'customer': {
+            'name': customer.name,
+            'phone': customer.phone,
+            'tin_number': customer.tin_number,
+        } if customer else None,
+        'lines': [
+            [product.name, product.selling_price, quantity, price]
+            for product, quantity, price in lines
+        ],
+    }
+
+
+def order_created_rows(payload, created_at):
+    """The OrderLog and Report rows that a checkout writes in sync mode, rebuilt from its event."""
+    customer = payload['customer']
+    logs = []
+    reports = []
+    for product_name, product_price, quantity, price in payload['lines']:
+        logs.append(OrderLog(
+            user=payload['user'],
+            action="Create",
+            model_name="Order",
+            object_id=payload['order_id'],
+            customer_info=customer['name'] if customer else None,
+            product_name=product_name,
+            quantity=quantity,
+            price=price,
+            changes_on_update="Created Order Item",
+            timestamp=created_at,
+        ))
+        reports.append(Report(
+            user=payload['user'],
+            customer_name=customer['name'] if customer else "Anonymous Customer",
+            customer_phone=customer['phone'] if customer else "0000000000",
+            customer_tin_number=customer['tin_number'] if customer else "1111",
+            order_date=payload['order_date'],
+            product_name=product_name,
+            product_price=product_price,
+            quantity=quantity,
+            price=price,
+        ))
+    return logs, reports
+
+
+def drain_audit_outbox(batch_size=500):
+    """
+    Turn up to `batch_size` queued events into OrderLog and Report rows.
+
+    The rows are bulk inserted and the events deleted in one transaction, so an
+    event is applied exactly once. Events locked by another worker are skipped
+    where the database supports it. Returns the number of events drained.
+    """
+    with transaction.atomic():
+        events = list(AuditOutboxEvent.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+        if not events:
+            return 0
+        logs = []
+        reports = []
+        for event in events:
+            if event.kind == 'order_created':
+                event_logs, event_reports = order_created_rows(event.payload, event.created_at)
+                logs.extend(event_logs)
+                reports.extend(event_reports)
+            elif event.kind == 'order_log':
+                logs.append(OrderLog(timestamp=event.created_at, **event.payload))
+            elif event.kind == 'order_report':
+                reports.append(Report(**event.payload))
+        OrderLog.objects.bulk_create(logs, batch_size=1000)
+        Report.objects.bulk_create(reports, batch_size=1000)
+        AuditOutboxEvent.objects.filter(pk__in=[event.pk for event in events]).delete()
+    return len(events)
+
+
+def audit_outbox_lag():
+    """How far the order log and report lag behind checkouts."""
+    pending = AuditOutboxEvent.objects.aggregate(count=Count('id'), oldest=Min('created_at'))
+    oldest = pending['oldest']
+    return {
+        'mode': settings.ORDER_AUDIT_MODE,
+        'pending_events': pending['count'],
+        'oldest_pending_at': oldest,
+        'lag_seconds': round((timezone.now() - oldest).total_seconds(), 3) if oldest else 0,
+    }
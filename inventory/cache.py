@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.cache import cache
+
+REFERENCE_LISTS = ('categories', 'suppliers', 'expense_types', 'company')
+
+
+def reference_key(name):
+    return f'inventory:reference:{name}'
+
+
+def stats_key(name, kind):
+    return f'inventory:reference:{name}:{kind}'
+
+
+def count(name, kind):
+    key = stats_key(name, kind)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # First event for this counter; add() keeps a concurrent first increment
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def cached_reference_list(name, build):
+    """
+    Return the serialized list `name` from the cache, building it with `build()` on a miss.
+
+    Entries stay until the model changes (see the receivers in models.py) or the
+    REFERENCE_CACHE_TIMEOUT setting expires them.
+    """
+    data = cache.get(reference_key(name))
+    if data is None:
+        count(name, 'misses')
+        data = list(build())
+        cache.set(reference_key(name), data, timeout=settings.REFERENCE_CACHE_TIMEOUT)
+    else:
+        count(name, 'hits')
+    return data
+
+
+def invalidate_reference_list(name):
+    cache.delete(reference_key(name))
+
+
+def reference_cache_stats():
+    keys = {stats_key(name, kind): (name, kind) for name in REFERENCE_LISTS for kind in ('hits', 'misses')}
+    values = cache.get_many(keys)
+    stats = {name: {'hits': 0, 'misses': 0} for name in REFERENCE_LISTS}
+    for key, (name, kind) in keys.items():
+        stats[name][kind] = values.get(key, 0)
+    return stats
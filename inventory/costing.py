@@ -0,0 +1,201 @@
+from collections import defaultdict, deque
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from django.conf import settings
+from django.db import transaction
+from .ledger import local_midnight
+from .models import (
+    CostLayer, Order, OrderItem, Product, StockMovement, UNIT_COST, add_item_sales, apply_sales_rollup, fallback_unit_cost,
+)
+from .rollups import rebuild_sales_rollup
+
+CENT = Decimal('0.01')
+
+
+def line_cost(unit_cost, quantity):
+    """Cost of an order line, rounded like the DecimalField column."""
+    return (unit_cost * quantity).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def current_unit_costs(product_ids):
+    """
+    {product_id: unit cost} of the products right now: the running average, else the buying price.
+
+    Lines of a Pending order are costed at this estimate while the stock is only
+    held; completing the order costs them at what their sale took out of stock.
+    """
+    return {
+        product_id: fallback_unit_cost(average_cost, buying_price)
+        for product_id, average_cost, buying_price in Product.objects.filter(pk__in=product_ids).values_list('id', 'average_cost', 'buying_price')
+    }
+
+
+def returned_unit_costs(stored, deltas):
+    """
+    Unit cost at which units taken off an order go back into stock: what the
+    order's lines of that product cost per unit. `stored` maps product ids to the
+    order's (quantity, cost) before the change.
+    """
+    return {
+        product_id: stored[product_id][1] / stored[product_id][0]
+        for product_id, quantity in deltas.items()
+        if quantity < 0 and stored.get(product_id, (0,))[0] > 0
+    }
+
+
+def order_line_costs(stored, deltas, movements):
+    """
+    Cost per product of an order's lines once `deltas` changed their quantities.
+
+    Added units cost what their sale movement was valued at, or the current unit
+    cost while a Pending order only holds them. Units taken off leave at the
+    lines' unit cost, which returned_unit_costs puts them back into stock at.
+    """
+    estimates = current_unit_costs([product_id for product_id, quantity in deltas.items() if quantity > 0 and product_id not in movements])
+    costs = {}
+    for product_id, delta in deltas.items():
+        quantity, cost = stored.get(product_id, (0, Decimal('0.00')))
+        if delta > 0:
+            unit_cost = movements[product_id].unit_cost if product_id in movements else estimates.get(product_id, Decimal('0'))
+            costs[product_id] = cost + unit_cost * delta
+        else:
+            costs[product_id] = cost * (quantity + delta) / quantity if quantity else Decimal('0.00')
+    return {product_id: cost.quantize(CENT, rounding=ROUND_HALF_UP) for product_id, cost in costs.items()}
+
+
+def cost_sold_lines(order, movements):
+    """
+    Re-cost the lines of a completed Pending order at what its sale movements were
+    valued at, moving the sales rollup by the difference.
+    """
+    items = [item for item in order.items.select_related('product') if item.product_id in movements]
+    sales = {}
+    for item in items:
+        add_item_sales(sales, order, item._stored, -1, item.product.category_id)
+        item.cost = line_cost(movements[item.product_id].unit_cost, item.quantity)
+        add_item_sales(sales, order, item.sales_snapshot(), 1, item.product.category_id)
+        item._stored = item.sales_snapshot()
+    OrderItem.objects.bulk_update(items, ['cost'])
+    apply_sales_rollup(sales)
+
+
+class ReplayedCosts:
+    """One product's cost layers and running average, rebuilt by replaying its movements."""
+
+    def __init__(self, buying_price):
+        self.buying_price = buying_price
+        self.layers = deque()
+        self.on_hand = 0
+        self.average = None
+
+    def receive(self, quantity, unit_cost, received_at):
+        # Same rules as post_stock_costs, one movement at a time
+        if unit_cost is None:
+            unit_cost = fallback_unit_cost(self.average, self.buying_price)
+        before = self.on_hand
+        self.on_hand += quantity
+        average = unit_cost if self.average is None or before <= 0 else (before * self.average + quantity * unit_cost) / self.on_hand
+        self.average = average.quantize(UNIT_COST)
+        self.layers.append([quantity, unit_cost, received_at])
+        return unit_cost
+
+    def issue(self, quantity):
+        fallback = fallback_unit_cost(self.average, self.buying_price)
+        covered, cost = 0, Decimal('0')
+        while self.layers and covered < quantity:
+            layer = self.layers[0]
+            units = min(layer[0], quantity - covered)
+            covered += units
+            cost += units * layer[1]
+            layer[0] -= units
+            if not layer[0]:
+                self.layers.popleft()
+        self.on_hand -= quantity
+        if settings.COSTING_METHOD == 'average':
+            return fallback
+        return ((cost + (quantity - covered) * fallback) / quantity).quantize(UNIT_COST)
+
+
+def recompute_costs(date_from=None, date_to=None, batch_size=1000):
+    """
+    Rebuild the cost of sales from the stock ledger for a date range (everything by default).
+
+    The ledger is replayed once, in order and streamed, under the current
+    COSTING_METHOD: purchases come in at their invoice price, returned units at
+    what the order sold them at, and everything else at the running average. The
+    movements recorded in the range are revalued, the lines of orders placed in
+    it get the cost their sales add up to, and the sales rollup of those dates is
+    rebuilt. The layers and averages the replay ends with replace the stored ones.
+    Products are locked throughout, so checkouts wait until it is done.
+
+    Returns (movements revalued, order lines re-costed).
+    """
+    start = local_midnight(date_from) if date_from else None
+    end = local_midnight(date_to + timedelta(days=1)) if date_to else None
+
+    def in_range(moment):
+        return (start is None or moment >= start) and (end is None or moment < end)
+
+    with transaction.atomic():
+        buying_prices = dict(Product.objects.select_for_update().order_by('id').values_list('id', 'buying_price'))
+        products = {}
+        # (order_id, product_id) -> [units sold, their cost], to value returns at
+        sold = defaultdict(lambda: [0, Decimal('0')])
+        revalued = []
+        movements = StockMovement.objects.order_by('created_at', 'id').values_list(
+            'id', 'product_id', 'quantity', 'reason', 'source_model', 'source_id', 'unit_cost', 'created_at'
+        )
+        for movement_id, product_id, quantity, reason, source_model, source_id, unit_cost, created_at in movements.iterator(chunk_size=2000):
+            state = products.get(product_id)
+            if state is None:
+                state = products[product_id] = ReplayedCosts(buying_prices.get(product_id))
+            line = sold[(source_id, product_id)] if source_model == 'order' else None
+            if quantity > 0:
+                given = unit_cost if reason == 'purchase' else None
+                if line is not None and line[0] > 0:
+                    given = line[1] / line[0]
+                value = state.receive(quantity, given, created_at)
+                if line is not None:
+                    line[0] -= quantity
+                    line[1] -= quantity * value
+            else:
+                value = state.issue(-quantity)
+                if line is not None:
+                    line[0] -= quantity
+                    line[1] -= quantity * value
+            if in_range(created_at) and value != unit_cost:
+                revalued.append(StockMovement(pk=movement_id, unit_cost=value))
+        # bulk_update goes around StockMovement.save(), which refuses changes to recorded movements
+        StockMovement.objects.bulk_update(revalued, ['unit_cost'], batch_size=batch_size)
+
+        orders = Order.objects.all()
+        if start:
+            orders = orders.filter(order_date__gte=start)
+        if end:
+            orders = orders.filter(order_date__lt=end)
+        order_ids = set(orders.values_list('id', flat=True))
+        lines = []
+        items = OrderItem.objects.filter(order_id__in=order_ids).only('id', 'order_id', 'product_id', 'quantity', 'cost')
+        for item in items.iterator(chunk_size=2000):
+            units, cost = sold.get((item.order_id, item.product_id), (0, None))
+            if units > 0 and line_cost(cost / units, item.quantity) != item.cost:
+                item.cost = line_cost(cost / units, item.quantity)
+                lines.append(item)
+        OrderItem.objects.bulk_update(lines, ['cost'], batch_size=batch_size)
+        rebuild_sales_rollup(date_from, date_to)
+
+        CostLayer.objects.all().delete()
+        CostLayer.objects.bulk_create(
+            [
+                CostLayer(product_id=product_id, received_at=received_at, remaining=remaining, unit_cost=unit_cost)
+                for product_id, state in products.items()
+                for remaining, unit_cost, received_at in state.layers
+            ],
+            batch_size=batch_size,
+        )
+        Product.objects.bulk_update(
+            [Product(pk=product_id, average_cost=state.average) for product_id, state in products.items()],
+            ['average_cost'],
+            batch_size=batch_size,
+        )
+    return len(revalued), len(lines)
@@ -0,0 +1,101 @@
+import hashlib
+from datetime import timedelta
+from functools import wraps
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from .models import IdempotencyKey
+
+
+def still_running():
+    return Response(
+        {"error": "A request with this Idempotency-Key is still being processed."},
+        status=status.HTTP_409_CONFLICT
+    )
+
+
+def claim_idempotency_key(user, endpoint, key, request_hash):
+    """
+    Reserve `key` for this request, or return the response a retry should get.
+
+    Must run inside the transaction that does the request's work: the claim row is
+    committed or rolled back with it, so a request that died leaves no claim behind
+    and one that is still running holds its claim locked. Returns (claim, None) when
+    the request should run, or (None, response) when it must not: the stored
+    response of a finished request, 409 while the first one is still running, or
+    422 when the key was used for a different request body.
+    """
+    for attempt in range(3):
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                existing = IdempotencyKey.objects.select_for_update(nowait=True).filter(user=user, endpoint=endpoint, key=key).first()
+                # Locked by us, so no running request holds it; without a response it was left by one that failed
+                if existing is not None and (existing.expires_at <= now or existing.status_code is None):
+                    existing.delete()
+                    existing = None
+                if existing is None:
+                    return IdempotencyKey.objects.create(
+                        key=key,
+                        user=user,
+                        endpoint=endpoint,
+                        request_hash=request_hash,
+                        expires_at=now + timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS),
+                    ), None
+        except IntegrityError:
+            # Claimed by a request that committed after the lookup; look again
+            continue
+        except OperationalError:
+            # The claim is locked by the request that is still running it (NOWAIT), or
+            # the two requests deadlocked inserting it
+            return None, still_running()
+        if existing.request_hash != request_hash:
+            return None, Response(
+                {"error": "This Idempotency-Key was already used for a different request."},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY
+            )
+        response = Response(existing.response_body, status=existing.status_code)
+        response['Idempotent-Replayed'] = 'true'
+        return None, response
+    return None, still_running()
+
+
+def idempotent(endpoint):
+    """
+    Let a POST view honour an `Idempotency-Key` header.
+
+    The first request with a key runs normally. Its key is claimed and its response
+    stored in the same transaction as the work it does, so either all of it is
+    committed or none is. A retry with the same key and body gets the stored
+    response back without the view running again; while the first request is still
+    running, a retry gets 409 (or waits for it where the database locks the claim
+    until then). However long a request takes, its claim is never taken over.
+    Server errors are not stored, so they can be retried. Requests without the
+    header are not affected.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if not key or not request.user.is_authenticated:
+                return method(self, request, *args, **kwargs)
+            if len(key) > 255:
+                return Response({"error": "Idempotency-Key must be at most 255 characters."}, status=status.HTTP_400_BAD_REQUEST)
+
+            request_hash = hashlib.sha256(request.body).hexdigest()
+            with transaction.atomic():
+                claim, response = claim_idempotency_key(request.user, endpoint, key, request_hash)
+                if response is not None:
+                    return response
+                response = method(self, request, *args, **kwargs)
+                if response.status_code < 500:
+                    claim.status_code = response.status_code
+                    claim.response_body = response.data
+                    claim.save(update_fields=['status_code', 'response_body'])
+                else:
+                    claim.delete()
+            return response
+        return wrapper
+    return decorator
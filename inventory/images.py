@@ -0,0 +1,113 @@
+import io
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image, ImageOps
+from rest_framework import serializers
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_FORMAT = 'WEBP'
+DERIVATIVE_EXTENSION = 'webp'
+
+executor = ThreadPoolExecutor(max_workers=settings.IMAGE_DERIVATIVE_WORKERS, thread_name_prefix='image-derivatives')
+
+
+def derivative_name(name, size):
+    """Storage name of the `size` derivative, next to the original: products/a.jpg -> products/a__thumb.webp"""
+    root, extension = posixpath.splitext(name)
+    return f'{root}__{size}.{DERIVATIVE_EXTENSION}'
+
+
+def generate_derivatives(name, storage=default_storage, force=False):
+    """
+    Write every size in IMAGE_DERIVATIVE_SIZES for the original image `name`.
+
+    Each derivative fits inside a square of its size, keeps the aspect ratio, has
+    the camera rotation applied and is re-encoded as WebP. Existing derivatives are
+    kept unless `force` is set. Returns the number of files written.
+    """
+    sizes = {
+        size: box for size, box in settings.IMAGE_DERIVATIVE_SIZES.items()
+        if force or not storage.exists(derivative_name(name, size))
+    }
+    if not sizes:
+        return 0
+    with storage.open(name, 'rb') as original:
+        image = ImageOps.exif_transpose(Image.open(original))
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+    for size, box in sizes.items():
+        resized = image.copy()
+        resized.thumbnail((box, box), Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, DERIVATIVE_FORMAT, quality=settings.IMAGE_DERIVATIVE_QUALITY, method=4)
+        target = derivative_name(name, size)
+        # storage.save() never overwrites; it would pick a new name instead
+        if storage.exists(target):
+            storage.delete(target)
+        storage.save(target, ContentFile(buffer.getvalue()))
+    return len(sizes)
+
+
+def run_generation(name, on_done=None):
+    try:
+        if generate_derivatives(name) and on_done:
+            on_done()
+    except Exception:
+        logger.exception('Could not generate derivatives for %s', name)
+    finally:
+        # Pool threads outlive requests, so do not leave their connection open
+        connection.close()
+
+
+def queue_derivatives(field_file, on_done=None):
+    """
+    Generate the derivatives of an uploaded image in the background once the upload is committed.
+
+    `on_done` runs in the worker after new derivatives were written, for callers that
+    cache representations holding the derivative URLs.
+    """
+    if field_file:
+        name = field_file.name
+        transaction.on_commit(lambda: executor.submit(run_generation, name, on_done))
+
+
+def copy_original(name, storage=default_storage):
+    """
+    Store the original under every derivative name, for an image that cannot be
+    resized, so its derivative URLs still serve it. Returns the number of files written.
+    """
+    with storage.open(name, 'rb') as original:
+        content = original.read()
+    for size in settings.IMAGE_DERIVATIVE_SIZES:
+        target = derivative_name(name, size)
+        if storage.exists(target):
+            storage.delete(target)
+        storage.save(target, ContentFile(content))
+    return len(settings.IMAGE_DERIVATIVE_SIZES)
+
+
+class ImageDerivativesField(serializers.ReadOnlyField):
+    """
+    URLs of an image's derivatives by size, e.g. {"thumb": ..., "small": ..., "medium": ...}.
+
+    The URLs are built from the stored name without asking the storage whether the
+    files exist, which would cost a round-trip per size and row on every listing.
+    Derivatives are written right after an upload commits, and
+    `manage.py generate_image_derivatives` covers images uploaded before that.
+    """
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        request = self.context.get('request')
+        urls = {}
+        for size in settings.IMAGE_DERIVATIVE_SIZES:
+            url = value.storage.url(derivative_name(value.name, size))
+            urls[size] = request.build_absolute_uri(url) if request is not None else url
+        return urls
@@ -0,0 +1,278 @@
+import csv
+import io
+import posixpath
+import re
+import zipfile
+from xml.etree.ElementTree import ParseError, iterparse
+from django.db import connection, transaction
+from rest_framework import serializers
+from .models import Product, Category, Supplier, bump_collection_version, record_changes
+from .stock import record_stock_movements
+
+IMPORT_BATCH_SIZE = 1000
+
+# Columns a price list may carry; anything else in the header is ignored
+IMPORT_COLUMNS = ('name', 'category', 'description', 'buying_price', 'selling_price', 'receipt', 'stock', 'supplier')
+
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+CELL_COLUMN = re.compile(r'[A-Z]+')
+
+
+class ProductImportRowSerializer(serializers.Serializer):
+    """Checks one row of an import file without touching the database."""
+    name = serializers.CharField(max_length=200)
+    category = serializers.CharField(max_length=100)
+    description = serializers.CharField(required=False, allow_null=True)
+    buying_price = serializers.DecimalField(max_digits=10, decimal_places=2, required=False, allow_null=True)
+    selling_price = serializers.DecimalField(max_digits=10, decimal_places=2)
+    receipt = serializers.BooleanField(required=False, default=False)
+    stock = serializers.IntegerField(min_value=0, required=False, default=0)
+    supplier = serializers.CharField(max_length=200, required=False)
+
+
+def read_csv_rows(upload):
+    """Yield the rows of an uploaded CSV file as lists of strings."""
+    upload.seek(0)
+    text = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+    try:
+        yield from csv.reader(text)
+    except csv.Error as e:
+        raise ValueError(f'The file is not a readable CSV file. {e}')
+    finally:
+        # Keep the upload open for Django to clean up
+        text.detach()
+
+
+def xlsx_column_index(reference):
+    index = 0
+    for letter in CELL_COLUMN.match(reference).group():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def first_sheet_path(workbook):
+    with workbook.open('xl/workbook.xml') as source:
+        sheet_id = next(element.get(f'{REL_NS}id') for event, element in iterparse(source) if element.tag == f'{SHEET_NS}sheet')
+    with workbook.open('xl/_rels/workbook.xml.rels') as rels:
+        for event, element in iterparse(rels):
+            if element.tag == f'{PACKAGE_REL_NS}Relationship' and element.get('Id') == sheet_id:
+                target = element.get('Target')
+                return target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+    raise KeyError(sheet_id)
+
+
+def read_shared_strings(workbook):
+    if 'xl/sharedStrings.xml' not in workbook.namelist():
+        return []
+    strings = []
+    with workbook.open('xl/sharedStrings.xml') as source:
+        for event, element in iterparse(source):
+            if element.tag == f'{SHEET_NS}si':
+                strings.append(''.join(text.text or '' for text in element.iter(f'{SHEET_NS}t')))
+                element.clear()
+    return strings
+
+
+def read_xlsx_rows(upload):
+    """
+    Yield the rows of the first sheet of an uploaded XLSX workbook as lists of strings.
+
+    The sheet is parsed incrementally and every row is discarded once it is read,
+    so memory use does not grow with the number of rows.
+    """
+    try:
+        workbook = zipfile.ZipFile(upload)
+        sheet_path = first_sheet_path(workbook)
+    except (zipfile.BadZipFile, KeyError, StopIteration):
+        raise ValueError('The file is not a readable XLSX workbook.')
+
+    try:
+        shared_strings = read_shared_strings(workbook)
+        with workbook.open(sheet_path) as sheet:
+            yield from sheet_rows(sheet, shared_strings)
+    except ParseError:
+        raise ValueError('The file is not a readable XLSX workbook.')
+
+
+def sheet_rows(sheet, shared_strings):
+    for event, element in iterparse(sheet):
+        if element.tag != f'{SHEET_NS}row':
+            continue
+        row = []
+        for position, cell in enumerate(element.iter(f'{SHEET_NS}c')):
+            reference = cell.get('r')
+            column = xlsx_column_index(reference) if reference else position
+            cell_type = cell.get('t')
+            if cell_type == 'inlineStr':
+                value = ''.join(text.text or '' for text in cell.iter(f'{SHEET_NS}t'))
+            else:
+                value = cell.findtext(f'{SHEET_NS}v') or ''
+                if cell_type == 's' and value:
+                    value = shared_strings[int(value)]
+            row.extend([''] * (column - len(row)))
+            row.append(value)
+        element.clear()
+        yield row
+
+
+def read_import_rows(upload):
+    """
+    Return the known columns of the upload's header and an iterator of
+    (row_number, {column: value}) over its non-empty data rows.
+    """
+    name = (upload.name or '').lower()
+    if name.endswith('.csv'):
+        rows = read_csv_rows(upload)
+    elif name.endswith('.xlsx'):
+        rows = read_xlsx_rows(upload)
+    else:
+        raise ValueError('Only .csv and .xlsx files can be imported.')
+
+    header = [column.strip().lower() for column in next(rows, [])]
+    missing = {'name', 'category', 'selling_price'} - set(header)
+    if missing:
+        raise ValueError(f"The file is missing the columns: {', '.join(sorted(missing))}.")
+    return {column for column in header if column in IMPORT_COLUMNS}, data_rows(header, rows)
+
+
+def data_rows(header, rows):
+    for row_number, values in enumerate(rows, start=2):
+        row = {
+            column: value.strip()
+            for column, value in zip(header, values)
+            if column in IMPORT_COLUMNS and value is not None and value.strip() != ''
+        }
+        if row:
+            yield row_number, row
+
+
+def import_products(upload, user_name, default_supplier=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Create or update products from a CSV or XLSX price list.
+
+    Rows are validated and written in batches of `batch_size`. Each batch is a single
+    upsert keyed on the unique_product_category constraint, so a product that already
+    exists in the category is updated in place. Only the columns in the file's header
+    are overwritten. Invalid rows, and repeats of a name and category seen earlier
+    in the file, are skipped and reported with their row number.
+    """
+    columns, rows = read_import_rows(upload)
+    # An existing product keeps the values of the columns the file does not carry
+    update_fields = sorted(columns - {'name', 'category'} | ({'supplier'} if default_supplier else set()))
+    result = {'total_rows': 0, 'created': 0, 'updated': 0, 'errors': []}
+    seen = set()
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            import_product_batch(batch, user_name, default_supplier, update_fields, seen, result)
+            batch = []
+    import_product_batch(batch, user_name, default_supplier, update_fields, seen, result)
+    return result
+
+
+def import_product_batch(batch, user_name, default_supplier, update_fields, seen, result):
+    if not batch:
+        return
+    result['total_rows'] += len(batch)
+    valid = []
+    # One serializer checks the whole batch, as ListSerializer does, instead of building its fields per row
+    serializer = ProductImportRowSerializer()
+    for row_number, row in batch:
+        try:
+            data = serializer.run_validation(row)
+        except serializers.ValidationError as e:
+            result['errors'].append({'row': row_number, 'errors': e.detail})
+            continue
+        key = (data['name'], data['category'])
+        if key in seen:
+            result['errors'].append({'row': row_number, 'errors': {'name': ['Duplicate of an earlier row with the same name and category.']}})
+            continue
+        seen.add(key)
+        valid.append((row_number, row, data))
+    if not valid:
+        return
+
+    with transaction.atomic():
+        categories = resolve_categories({data['category'] for row_number, row, data in valid}, user_name)
+        suppliers = dict(
+            Supplier.objects.filter(name__in={data['supplier'] for row_number, row, data in valid if 'supplier' in data})
+            .order_by('-id')
+            .values_list('name', 'id')
+        )
+
+        products = []
+        for row_number, row, data in valid:
+            supplier_id = default_supplier.id if default_supplier else None
+            if 'supplier' in data:
+                supplier_id = suppliers.get(data['supplier'])
+                if supplier_id is None:
+                    result['errors'].append({'row': row_number, 'errors': {'supplier': [f"Supplier '{data['supplier']}' does not exist."]}})
+                    continue
+            products.append(Product(
+                name=data['name'],
+                category_id=categories[data['category']],
+                description=data.get('description'),
+                buying_price=data.get('buying_price'),
+                selling_price=data['selling_price'],
+                receipt=data['receipt'],
+                stock=data['stock'],
+                supplier_id=supplier_id,
+                user=user_name,
+            ))
+        if not products:
+            return
+
+        keys = {(product.name, product.category_id) for product in products}
+        # Locked with their stock read, so the ledger gets the difference the upsert makes
+        existing = {
+            (name, category_id): stock
+            for name, category_id, stock in Product.objects.select_for_update().filter(
+                name__in={name for name, category_id in keys},
+                category_id__in={category_id for name, category_id in keys},
+            ).values_list('name', 'category_id', 'stock')
+            if (name, category_id) in keys
+        }
+
+        upsert = {'update_conflicts': True, 'update_fields': update_fields}
+        if connection.features.supports_update_conflicts_with_target:
+            upsert['unique_fields'] = ['name', 'category']
+        Product.objects.bulk_create(products, **upsert)
+
+        # Bulk inserts send no signals, so journal the rows and bump the list version here
+        ids = {
+            (name, category_id): product_id
+            for product_id, name, category_id in Product.objects.filter(
+                name__in={name for name, category_id in keys},
+                category_id__in={category_id for name, category_id in keys},
+            ).values_list('id', 'name', 'category_id')
+        }
+        record_changes('product', [ids[key] for key in keys - existing.keys() if key in ids], 'created')
+        record_changes('product', [ids[key] for key in keys & existing.keys() if key in ids], 'updated')
+        if keys & existing.keys() and {'buying_price', 'selling_price'} & set(update_fields):
+            # Order lines embed the price of the products they sold
+            bump_collection_version('products', 'orders')
+        else:
+            bump_collection_version('products')
+
+        # A stock column in the file is a count of what is on the shelf
+        counted = {}
+        for product in products:
+            key = (product.name, product.category_id)
+            if key in ids and (key not in existing or 'stock' in update_fields):
+                counted[ids[key]] = product.stock - existing.get(key, 0)
+        record_stock_movements(counted, 'stocktake', user=user_name)
+
+    result['created'] += len(keys - existing.keys())
+    result['updated'] += len(keys & existing.keys())
+
+
+def resolve_categories(names, user_name):
+    """Map category names to ids, creating the categories the file introduces."""
+    categories = dict(Category.objects.filter(name__in=names).values_list('name', 'id'))
+    for name in names - set(categories):
+        # Saved one by one so the category signals (cache, journal) still run
+        categories[name] = Category.objects.get_or_create(name=name, defaults={'user': user_name})[0].id
+    return categories
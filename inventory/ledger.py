@@ -0,0 +1,85 @@
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min, Sum
+from django.utils import timezone
+from .models import StockMovement, StockSnapshot
+
+# Movements are stamped before their transaction commits, so a snapshot is only
+# taken for a moment at least this far in the past
+SNAPSHOT_SETTLE = timedelta(hours=1)
+
+
+def local_midnight(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def movement_totals(after, until, product_ids=None):
+    """(product_id, summed change) for the movements in (after, until], one index range scan."""
+    movements = StockMovement.objects.filter(created_at__lte=until)
+    if after is not None:
+        movements = movements.filter(created_at__gt=after)
+    if product_ids is not None:
+        movements = movements.filter(product_id__in=product_ids)
+    return movements.order_by().values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total')
+
+
+def write_snapshot(previous, as_of):
+    """Snapshot every product at `as_of` as the `previous` snapshot plus the movements since."""
+    quantities = {}
+    if previous is not None:
+        quantities = dict(StockSnapshot.objects.filter(as_of=previous).values_list('product_id', 'quantity'))
+    for product_id, total in movement_totals(previous, as_of):
+        quantities[product_id] = quantities.get(product_id, 0) + total
+    StockSnapshot.objects.bulk_create(
+        [StockSnapshot(product_id=product_id, as_of=as_of, quantity=quantity) for product_id, quantity in quantities.items()],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    return len(quantities)
+
+
+def take_stock_snapshots(now=None):
+    """
+    Write the snapshots that are due and return how many rows were written.
+
+    Snapshots fall on local midnight every STOCK_SNAPSHOT_INTERVAL_DAYS, starting
+    the day after the first movement. Each one is built from the one before it and
+    the movements in between, so a run only reads the ledger it has not summed yet.
+    """
+    cutoff = (now or timezone.now()) - SNAPSHOT_SETTLE
+    interval = timedelta(days=settings.STOCK_SNAPSHOT_INTERVAL_DAYS)
+    previous = StockSnapshot.objects.aggregate(as_of=Max('as_of'))['as_of']
+    if previous is not None:
+        as_of = local_midnight(timezone.localdate(previous) + interval)
+    else:
+        first = StockMovement.objects.aggregate(created_at=Min('created_at'))['created_at']
+        if first is None:
+            return 0
+        as_of = local_midnight(timezone.localdate(first) + timedelta(days=1))
+
+    written = 0
+    while as_of <= cutoff:
+        with transaction.atomic():
+            written += write_snapshot(previous, as_of)
+        previous, as_of = as_of, local_midnight(timezone.localdate(as_of) + interval)
+    return written
+
+
+def stock_at(when, product_ids=None):
+    """
+    {product_id: stock} at the moment `when`, for `product_ids` or every product.
+
+    Starts from the latest snapshot taken at or before `when` and adds the
+    movements since, so the cost does not grow with the age of the ledger.
+    """
+    as_of = StockSnapshot.objects.filter(as_of__lte=when).aggregate(as_of=Max('as_of'))['as_of']
+    stock = {}
+    if as_of is not None:
+        snapshots = StockSnapshot.objects.filter(as_of=as_of)
+        if product_ids is not None:
+            snapshots = snapshots.filter(product_id__in=product_ids)
+        stock = dict(snapshots.values_list('product_id', 'quantity'))
+    for product_id, total in movement_totals(as_of, when, product_ids):
+        stock[product_id] = stock.get(product_id, 0) + total
+    return stock
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from inventory.audit import drain_audit_outbox
+
+
+class Command(BaseCommand):
+    help = "Write the order log and report rows queued by checkouts in outbox mode."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Events drained per transaction.")
+        parser.add_argument('--loop', action='store_true', help="Keep running and poll for new events.")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to wait when the outbox is empty (with --loop).")
+
+    def handle(self, *args, **options):
+        drained = 0
+        while True:
+            close_old_connections()
+            count = drain_audit_outbox(options['batch_size'])
+            drained += count
+            if count:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Drained {drained} audit events."))
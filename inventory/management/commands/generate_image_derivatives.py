@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from inventory.cache import invalidate_reference_list
+from inventory.images import copy_original, generate_derivatives
+from inventory.models import IMAGE_FIELDS, Product, record_product_changes
+
+
+class Command(BaseCommand):
+    help = "Generate the resized derivatives of existing product, company logo and profile images."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help="Regenerate derivatives that already exist.")
+
+    def handle(self, *args, **options):
+        written = failed = 0
+        updated_products = []
+        for model, field in IMAGE_FIELDS.items():
+            rows = (
+                model.objects.exclude(**{f'{field}__isnull': True}).exclude(**{field: ''})
+                .order_by('pk').values_list('pk', field)
+            )
+            for pk, name in rows.iterator():
+                try:
+                    count = generate_derivatives(name, force=options['force'])
+                except (OSError, ValueError) as e:
+                    # A missing or unreadable original should not stop the backfill
+                    failed += 1
+                    self.stderr.write(f"{model.__name__} {pk} image {name}: {e}")
+                    try:
+                        # Serializers link the derivatives without checking for them,
+                        # so let those URLs serve the original instead
+                        count = copy_original(name)
+                    except OSError:
+                        continue
+                written += count
+                if count and model is Product:
+                    updated_products.append(pk)
+
+        # Product payloads and the cached company list carry the derivative URLs
+        record_product_changes(updated_products)
+        if written:
+            invalidate_reference_list('company')
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} derivatives; {failed} images could not be resized."))
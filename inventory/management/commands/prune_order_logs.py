@@ -0,0 +1,49 @@
+import csv
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from inventory.models import OrderLog
+
+ARCHIVE_COLUMNS = ['id', 'user', 'action', 'model_name', 'object_id', 'timestamp', 'customer_info', 'product_name', 'quantity', 'price', 'changes_on_update']
+
+
+class Command(BaseCommand):
+    help = "Delete (and optionally archive) order log rows older than the retention period, in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ORDER_LOG_RETENTION_DAYS, help="Keep rows newer than this many days.")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows deleted per statement.")
+        parser.add_argument('--pause', type=float, default=0.0, help="Seconds to sleep between batches.")
+        parser.add_argument('--archive', help="Append the removed rows to this CSV file before deleting them.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        expired = OrderLog.objects.filter(timestamp__lt=cutoff).order_by('id')
+        archive = open(options['archive'], 'a', newline='') if options['archive'] else None
+        writer = csv.writer(archive) if archive else None
+        if archive and archive.tell() == 0:
+            writer.writerow(ARCHIVE_COLUMNS)
+
+        removed = 0
+        try:
+            while True:
+                # Each batch is its own short statement, so the table is never locked for long
+                if writer:
+                    rows = list(expired.values_list(*ARCHIVE_COLUMNS)[:options['batch_size']])
+                    ids = [row[0] for row in rows]
+                    writer.writerows(rows)
+                    archive.flush()
+                else:
+                    ids = list(expired.values_list('id', flat=True)[:options['batch_size']])
+                if not ids:
+                    break
+                removed += OrderLog.objects.filter(id__in=ids).delete()[0]
+                if options['pause']:
+                    time.sleep(options['pause'])
+        finally:
+            if archive:
+                archive.close()
+
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} order log rows older than {cutoff:%Y-%m-%d}."))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from inventory.rollups import rebuild_sales_rollup
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily sales rollup from order items, for all dates or a date range."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', help="First date to rebuild (YYYY-MM-DD).")
+        parser.add_argument('--to', dest='date_to', help="Last date to rebuild (YYYY-MM-DD).")
+
+    def handle(self, *args, **options):
+        dates = {}
+        for name in ('date_from', 'date_to'):
+            value = options[name]
+            dates[name] = parse_date(value) if value else None
+            if value and dates[name] is None:
+                raise CommandError(f"Invalid date: {value}")
+
+        count = rebuild_sales_rollup(**dates)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} rollup rows."))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from inventory.costing import recompute_costs
+
+
+class Command(BaseCommand):
+    help = "Recompute the cost of sales from the stock ledger, for all dates or a date range."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', help="First date to recompute (YYYY-MM-DD).")
+        parser.add_argument('--to', dest='date_to', help="Last date to recompute (YYYY-MM-DD).")
+
+    def handle(self, *args, **options):
+        dates = {}
+        for name in ('date_from', 'date_to'):
+            value = options[name]
+            dates[name] = parse_date(value) if value else None
+            if value and dates[name] is None:
+                raise CommandError(f"Invalid date: {value}")
+
+        movements, lines = recompute_costs(**dates)
+        self.stdout.write(self.style.SUCCESS(f"Revalued {movements} stock movements and {lines} order lines."))
@@ -0,0 +1,27 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from inventory.reservations import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "Give back the stock held by Pending orders whose reservation has expired."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Holds released per transaction.")
+        parser.add_argument('--loop', action='store_true', help="Keep running and release holds as they expire.")
+        parser.add_argument('--interval', type=float, default=60.0, help="Seconds to wait when nothing has expired (with --loop).")
+
+    def handle(self, *args, **options):
+        released = 0
+        while True:
+            close_old_connections()
+            count = release_expired_reservations(options['batch_size'])
+            released += count
+            if count:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f"Released {released} expired stock reservations."))
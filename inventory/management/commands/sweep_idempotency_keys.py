@@ -0,0 +1,28 @@
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from inventory.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Delete expired idempotency keys and their stored responses, in small batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows deleted per statement.")
+        parser.add_argument('--pause', type=float, default=0.0, help="Seconds to sleep between batches.")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expired = IdempotencyKey.objects.filter(expires_at__lte=now).order_by('expires_at')
+
+        removed = 0
+        while True:
+            # Each batch is its own short statement, so the table is never locked for long
+            ids = list(expired.values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            removed += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(f"Removed {removed} expired idempotency keys."))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from inventory.ledger import take_stock_snapshots
+
+
+class Command(BaseCommand):
+    help = "Sum the stock ledger into the per-product snapshots that are due."
+
+    def handle(self, *args, **options):
+        written = take_stock_snapshots()
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} stock snapshot rows."))
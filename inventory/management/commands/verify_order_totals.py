@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from inventory.orders import find_order_total_mismatches, repair_order_totals
+
+
+class Command(BaseCommand):
+    help = "Compare every order's stored total with the sum of its item prices."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help="Overwrite mismatched totals with the item sums.")
+
+    def handle(self, *args, **options):
+        mismatches = list(find_order_total_mismatches())
+        for row in mismatches:
+            self.stdout.write(f"Order {row['id']}: stored {row['total_amount']}, items sum to {row['items_total']}")
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("All order totals match their items."))
+            return
+
+        if options['fix']:
+            fixed = repair_order_totals([row['id'] for row in mismatches])
+            self.stdout.write(self.style.SUCCESS(f"Repaired {fixed} order totals."))
+        else:
+            self.stdout.write(self.style.WARNING(f"{len(mismatches)} orders have a mismatched total. Run with --fix to repair them."))
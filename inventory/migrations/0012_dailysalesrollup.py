@@ -0,0 +1,62 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_sales_rollup(apps, schema_editor):
+    OrderItem = apps.get_model('inventory', 'OrderItem')
+    DailySalesRollup = apps.get_model('inventory', 'DailySalesRollup')
+    grouped = (
+        OrderItem.objects.annotate(date=TruncDate('order__order_date'))
+        .values('date', 'product_id', 'product__category_id', 'order__user')
+        .annotate(revenue=Sum('price'), cost=Sum('cost'), quantity=Sum('quantity'), line_count=Count('id'))
+        .order_by()
+    )
+    DailySalesRollup.objects.bulk_create(
+        [
+            DailySalesRollup(
+                date=row['date'],
+                product_id=row['product_id'],
+                category_id=row['product__category_id'],
+                user=row['order__user'],
+                revenue=row['revenue'] or 0,
+                cost=row['cost'] or 0,
+                quantity=row['quantity'] or 0,
+                line_count=row['line_count'],
+            )
+            for row in grouped.iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0011_product_product_name_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('user', models.CharField(blank=True, max_length=255, null=True)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('cost', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('quantity', models.IntegerField(default=0)),
+                ('line_count', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inventory.category')),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='inventory.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date', 'user'], name='sales_rollup_date_user_idx')],
+                'constraints': [models.UniqueConstraint(fields=('date', 'product', 'category', 'user'), name='unique_daily_sales_rollup')],
+            },
+        ),
+        migrations.RunPython(backfill_sales_rollup, migrations.RunPython.noop),
+    ]
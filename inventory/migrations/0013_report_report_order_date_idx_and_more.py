@@ -0,0 +1,21 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0012_dailysalesrollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='report',
+            index=models.Index(fields=['order_date'], name='report_order_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='report',
+            index=models.Index(fields=['user', 'order_date'], name='report_user_order_date_idx'),
+        ),
+    ]
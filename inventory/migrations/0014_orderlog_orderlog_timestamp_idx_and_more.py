@@ -0,0 +1,29 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0013_report_report_order_date_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='orderlog',
+            index=models.Index(fields=['timestamp'], name='orderlog_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderlog',
+            index=models.Index(fields=['model_name', 'timestamp'], name='orderlog_model_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderlog',
+            index=models.Index(fields=['action', 'timestamp'], name='orderlog_action_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderlog',
+            index=models.Index(fields=['user', 'timestamp'], name='orderlog_user_timestamp_idx'),
+        ),
+    ]
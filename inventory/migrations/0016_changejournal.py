@@ -0,0 +1,36 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def seed_change_journal(apps, schema_editor):
+    # Existing rows enter the journal as created, so a client syncing from 0 gets a full snapshot
+    ChangeJournal = apps.get_model('inventory', 'ChangeJournal')
+    now = django.utils.timezone.now()
+    for model, model_name in (('Product', 'product'), ('CustomerInfo', 'customer'), ('Category', 'category'), ('Supplier', 'supplier')):
+        ids = apps.get_model('inventory', model).objects.order_by('id').values_list('id', flat=True)
+        ChangeJournal.objects.bulk_create(
+            [ChangeJournal(model_name=model_name, object_id=object_id, action='created', changed_at=now) for object_id in ids.iterator()],
+            batch_size=1000,
+        )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0015_collectionversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeJournal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(max_length=30)),
+                ('object_id', models.PositiveBigIntegerField()),
+                ('action', models.CharField(choices=[('created', 'created'), ('updated', 'updated'), ('deleted', 'deleted')], max_length=10)),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(seed_change_journal, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0016_changejournal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='reorder_point',
+            field=models.PositiveIntegerField(default=3),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='reorder_quantity',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='is_low_stock',
+            field=models.GeneratedField(db_persist=True, expression=models.Case(models.When(stock__lte=models.F('reorder_point'), then=models.Value(True)), default=models.Value(False)), output_field=models.BooleanField()),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['is_low_stock', 'id'], name='product_low_stock_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:31
+
+import django.core.serializers.json
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0019_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditOutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('order_created', 'order_created'), ('order_log', 'order_log'), ('order_report', 'order_report')], max_length=20)),
+                ('payload', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='orderlog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='report',
+            name='order_date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:43
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0021_product_reserved_alter_order_status_stockreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchaseproduct',
+            name='stock_product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='purchase_lines', to='inventory.product'),
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('reason', models.CharField(choices=[('purchase', 'purchase')], max_length=20)),
+                ('source_model', models.CharField(blank=True, max_length=30, null=True)),
+                ('source_id', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('unit_cost', models.DecimalField(blank=True, decimal_places=2, max_digits=20, null=True)),
+                ('user', models.CharField(blank=True, default='User', max_length=255, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='inventory.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', 'created_at', 'id'], name='stock_movement_product_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:48
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def seed_opening_balances(apps, schema_editor):
+    # Each product opens the ledger with the stock its movements so far do not explain,
+    # so the movements of every product add up to its stock from here on
+    Product = apps.get_model('inventory', 'Product')
+    StockMovement = apps.get_model('inventory', 'StockMovement')
+    recorded = dict(StockMovement.objects.order_by().values('product_id').annotate(total=Sum('quantity')).values_list('product_id', 'total'))
+    now = django.utils.timezone.now()
+    StockMovement.objects.bulk_create(
+        [
+            StockMovement(product_id=product_id, quantity=stock - recorded.get(product_id, 0), reason='opening', created_at=now)
+            for product_id, stock in Product.objects.order_by('id').values_list('id', 'stock').iterator()
+            if stock != recorded.get(product_id, 0)
+        ],
+        batch_size=1000,
+    )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0022_purchaseproduct_stock_product_stockmovement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('as_of', models.DateTimeField()),
+                ('quantity', models.IntegerField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='reason',
+            field=models.CharField(choices=[('opening', 'opening'), ('sale', 'sale'), ('edit', 'edit'), ('delete', 'delete'), ('purchase', 'purchase'), ('adjustment', 'adjustment'), ('stocktake', 'stocktake')], max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='stockmovement',
+            index=models.Index(fields=['created_at', 'id'], name='stock_movement_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='stocksnapshot',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='inventory.product'),
+        ),
+        migrations.AddConstraint(
+            model_name='stocksnapshot',
+            constraint=models.UniqueConstraint(fields=('as_of', 'product'), name='unique_stock_snapshot'),
+        ),
+        migrations.RunPython(seed_opening_balances, migrations.RunPython.noop),
+    ]
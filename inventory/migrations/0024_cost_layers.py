@@ -0,0 +1,56 @@
+# Generated by Django 5.1.1 on 2026-10-18 15:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import F
+
+
+def seed_cost_layers(apps, schema_editor):
+    # Stock on hand is valued at the buying price it was costed at so far; `manage.py
+    # recompute_costs` can revalue it from the purchases in the stock ledger instead
+    Product = apps.get_model('inventory', 'Product')
+    CostLayer = apps.get_model('inventory', 'CostLayer')
+    Product.objects.update(average_cost=F('buying_price'))
+    CostLayer.objects.bulk_create(
+        [
+            CostLayer(product_id=product_id, remaining=stock, unit_cost=buying_price if buying_price is not None else Decimal('0'))
+            for product_id, stock, buying_price in Product.objects.filter(stock__gt=0).order_by('id').values_list('id', 'stock', 'buying_price').iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0023_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='average_cost',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=20, null=True),
+        ),
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='unit_cost',
+            field=models.DecimalField(blank=True, decimal_places=6, max_digits=20, null=True),
+        ),
+        migrations.CreateModel(
+            name='CostLayer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('remaining', models.PositiveIntegerField()),
+                ('unit_cost', models.DecimalField(decimal_places=6, max_digits=20)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cost_layers', to='inventory.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', 'received_at', 'id'], name='cost_layer_fifo_idx')],
+            },
+        ),
+        migrations.RunPython(seed_cost_layers, migrations.RunPython.noop),
+    ]
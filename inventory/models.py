@@ -1,11 +1,17 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.utils import timezone
+from django.core.serializers.json import DjangoJSONEncoder
 from user.models import UserAccount
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete, pre_save
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete
 from django.db.models import UniqueConstraint
 from django.core.exceptions import ValidationError
-from django.db.models import Sum
+from django.db.models import Sum, F, Q, Case, When, Value, Window
+from django.conf import settings
+from collections import defaultdict
 from decimal import Decimal
+from .cache import invalidate_reference_list
+from .images import queue_derivatives
 
 
 
@@ -20,12 +26,21 @@ class OrderLog(models.Model):
     action = models.CharField(max_length=10, choices=ACTION_CHOICES, null=True, blank=True)
     model_name = models.CharField(max_length=50, null=True, blank=True)
     object_id = models.PositiveIntegerField(null=True, blank=True)  # ID of the object affected
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: rows drained from the audit outbox keep the time of the checkout
+    timestamp = models.DateTimeField(default=timezone.now)
     customer_info = models.CharField(max_length=255, default="Customer", null=True, blank=True)
     product_name = models.CharField(max_length=255, default="Product", null=True, blank=True)
     quantity = models.PositiveIntegerField(null=True, blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, null=True, blank=True)
     changes_on_update = models.TextField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['timestamp'], name='orderlog_timestamp_idx'),
+            models.Index(fields=['model_name', 'timestamp'], name='orderlog_model_timestamp_idx'),
+            models.Index(fields=['action', 'timestamp'], name='orderlog_action_timestamp_idx'),
+            models.Index(fields=['user', 'timestamp'], name='orderlog_user_timestamp_idx'),
+        ]
     
     def __str__(self):
         return f"{self.action} - {self.model_name} ({self.object_id}) at {self.timestamp}"
@@ -56,15 +71,36 @@ class Product(models.Model):
     supplier = models.ForeignKey(Supplier, on_delete=models.SET_NULL, null=True, blank=True)
     image = models.ImageField(upload_to='products/', null=True, blank=True)
     user = models.CharField(max_length=255, default="User", null=True, blank=True)
+    reorder_point = models.PositiveIntegerField(default=3)
+    reorder_quantity = models.PositiveIntegerField(default=0)
+    # Units held for Pending orders (see StockReservation); still counted in `stock`
+    reserved = models.PositiveIntegerField(default=0)
+    # Running weighted average cost of the units in stock (see post_stock_costs)
+    average_cost = models.DecimalField(max_digits=20, decimal_places=6, null=True, blank=True)
+    # Kept by the database, so it stays right for every kind of stock update, F() ones included
+    is_low_stock = models.GeneratedField(
+        expression=Case(When(stock__lte=F('reorder_point'), then=Value(True)), default=Value(False)),
+        output_field=models.BooleanField(),
+        db_persist=True,
+    )
 
     class Meta:
         constraints = [
             UniqueConstraint(fields=['name', 'category'], name='unique_product_category')
         ]
+        indexes = [
+            models.Index(fields=['name', 'id'], name='product_name_id_idx'),
+            models.Index(fields=['is_low_stock', 'id'], name='product_low_stock_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    @property
+    def available_stock(self):
+        """Stock that can still be sold: on hand minus what Pending orders hold."""
+        return max(self.stock - self.reserved, 0)
+
 class CustomerInfo(models.Model):
     name = models.CharField(max_length=255, default="Customer", null=True, blank=True)
     phone = models.CharField(max_length=255, null=True, blank=True)
@@ -98,10 +134,18 @@ class CompanyInfo(models.Model):
 class Order(models.Model):
     customer = models.ForeignKey(CustomerInfo, on_delete=models.SET_NULL, null=True, blank=True)
     order_date = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=100, choices=(('Pending', 'Pending'), ('Completed', 'Completed')), null=True, blank=True)
+    status = models.CharField(max_length=100, choices=(('Pending', 'Pending'), ('Completed', 'Completed'), ('Expired', 'Expired')), null=True, blank=True)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     user = models.CharField(max_length=255, default="User", null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['order_date', 'id'], name='order_date_idx'),
+            models.Index(fields=['status', 'order_date'], name='order_status_date_idx'),
+            models.Index(fields=['customer', 'order_date'], name='order_customer_date_idx'),
+            models.Index(fields=['user', 'order_date'], name='order_user_date_idx'),
+        ]
+
     def str(self):
         return self.customer
     
@@ -113,6 +157,13 @@ class Order(models.Model):
         """Calculate the total price of the entire order."""
         return sum(item.get_price() for item in self.items.all())
 
+
+def apply_order_total_delta(order_id, delta):
+    """Add `delta` to an order's stored total in the database, without reading its items."""
+    if order_id and delta:
+        Order.objects.filter(pk=order_id).update(total_amount=F('total_amount') + delta)
+
+
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True)
@@ -122,6 +173,19 @@ class OrderItem(models.Model):
     cost = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, null=True, blank=True)
     receipt = models.BooleanField(default=False)
 
+    SALES_FIELDS = ('product_id', 'quantity', 'price', 'cost')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored figures so saves can adjust totals and rollups by the difference
+        if all(field in instance.__dict__ for field in cls.SALES_FIELDS):
+            instance._stored = instance.sales_snapshot()
+        return instance
+
+    def sales_snapshot(self):
+        return {field: getattr(self, field) for field in self.SALES_FIELDS}
+
     def save(self, *args, **kwargs):
         """Automatically set receipt to True if the product's receipt is True"""
         if self.product and self.product.receipt:
@@ -140,20 +204,473 @@ class OrderItem(models.Model):
         """Calculate the total price of this item."""
         return self.product.buying_price * self.quantity
 
+class StockReservation(models.Model):
+    """
+    Stock held for a Pending order until it is completed or `expires_at` passes.
+
+    Held units stay in Product.stock and are counted in Product.reserved, so
+    available stock is one subtraction on the product row.
+    """
+    order = models.ForeignKey(Order, related_name='reservations', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['order', 'product'], name='unique_order_product_reservation')
+        ]
+        indexes = [
+            models.Index(fields=['expires_at', 'id'], name='reservation_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.order_id} - {self.product_id} x {self.quantity}"
+
 class Report(models.Model):
     user = models.CharField(max_length=50, default="user", blank=True, null=True)
     customer_name = models.CharField(max_length=255, default="Customer", null=True, blank=True)
     customer_phone = models.CharField(max_length=255, default="Customer", null=True, blank=True)
     customer_tin_number = models.CharField(max_length=255, default="Customer", null=True, blank=True)
-    order_date = models.DateTimeField(auto_now_add=True)
+    order_date = models.DateTimeField(default=timezone.now)
     product_name = models.CharField(max_length=255, default="Product", null=True, blank=True)
     product_price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
     quantity = models.IntegerField()
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['order_date'], name='report_order_date_idx'),
+            models.Index(fields=['user', 'order_date'], name='report_user_order_date_idx'),
+        ]
+
     def __str__(self):
         return self.user
 
+class DailySalesRollup(models.Model):
+    """Sales pre-aggregated per day, product, category and salesperson for the dashboards."""
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True)
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
+    user = models.CharField(max_length=255, null=True, blank=True)
+    revenue = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    cost = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    quantity = models.IntegerField(default=0)
+    line_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['date', 'product', 'category', 'user'], name='unique_daily_sales_rollup')
+        ]
+        indexes = [
+            models.Index(fields=['date', 'user'], name='sales_rollup_date_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.product_id} - {self.revenue}"
+
+
+def sales_rollup_key(order, product_id, category_id):
+    return (timezone.localdate(order.order_date), product_id, category_id, order.user)
+
+
+def product_category_id(product_id):
+    if not product_id:
+        return None
+    return Product.objects.filter(pk=product_id).values_list('category_id', flat=True).first()
+
+
+def add_item_sales(deltas, order, values, sign, category_id):
+    """Add (sign=1) or remove (sign=-1) one item's figures to the pending rollup deltas."""
+    if not values:
+        return
+    row = deltas.setdefault(sales_rollup_key(order, values['product_id'], category_id), [Decimal('0.00'), Decimal('0.00'), 0, 0])
+    row[0] += sign * Decimal(values['price'] or 0)
+    row[1] += sign * Decimal(values['cost'] or 0)
+    row[2] += sign * (values['quantity'] or 0)
+    row[3] += sign
+
+
+def add_to_rollup_row(key, values):
+    """Add one key's figures with an UPDATE, or an INSERT for the key's first sale."""
+    revenue, cost, quantity, line_count = values
+    date, product_id, category_id, user = key
+    lookup = {'date': date, 'product_id': product_id, 'category_id': category_id, 'user': user}
+    changes = {
+        'revenue': F('revenue') + revenue,
+        'cost': F('cost') + cost,
+        'quantity': F('quantity') + quantity,
+        'line_count': F('line_count') + line_count,
+    }
+    if DailySalesRollup.objects.filter(**lookup).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            DailySalesRollup.objects.create(revenue=revenue, cost=cost, quantity=quantity, line_count=line_count, **lookup)
+    except IntegrityError:
+        # Another checkout created the row first
+        DailySalesRollup.objects.filter(**lookup).update(**changes)
+
+
+def apply_sales_rollup(deltas):
+    """
+    Add {(date, product_id, category_id, user): [revenue, cost, quantity, line_count]}
+    to the daily rollup.
+
+    The rows of all keys are looked up in one query. Keys sold for the first time
+    are inserted together and the rest are updated by one UPDATE, so the cost does
+    not grow with the number of lines. If another checkout inserts one of the new
+    keys first, the new keys fall back to add_to_rollup_row.
+    """
+    deltas = {key: values for key, values in deltas.items() if any(values)}
+    if not deltas:
+        return
+    product_ids = {key[1] for key in deltas} - {None}
+    rows = DailySalesRollup.objects.filter(
+        Q(product_id__in=product_ids) | Q(product__isnull=True),
+        date__in={key[0] for key in deltas},
+    ).values_list('id', 'date', 'product_id', 'category_id', 'user')
+    existing = {}
+    for row_id, *key in rows:
+        existing.setdefault(tuple(key), row_id)
+
+    new_keys = [key for key in deltas if key not in existing]
+    if new_keys:
+        try:
+            with transaction.atomic():
+                DailySalesRollup.objects.bulk_create([
+                    DailySalesRollup(
+                        date=date, product_id=product_id, category_id=category_id, user=user,
+                        revenue=deltas[key][0], cost=deltas[key][1], quantity=deltas[key][2], line_count=deltas[key][3],
+                    )
+                    for key in new_keys
+                    for date, product_id, category_id, user in [key]
+                ])
+        except IntegrityError:
+            for key in sorted(new_keys, key=str):
+                add_to_rollup_row(key, deltas[key])
+
+    by_row = {existing[key]: values for key, values in deltas.items() if key in existing}
+    if by_row:
+        def per_row(position, output_field):
+            return Case(
+                *[When(pk=row_id, then=Value(values[position])) for row_id, values in by_row.items()],
+                default=Value(0),
+                output_field=output_field,
+            )
+        amount = models.DecimalField(max_digits=20, decimal_places=2)
+        DailySalesRollup.objects.filter(pk__in=by_row).update(
+            revenue=F('revenue') + per_row(0, amount),
+            cost=F('cost') + per_row(1, amount),
+            quantity=F('quantity') + per_row(2, models.IntegerField()),
+            line_count=F('line_count') + per_row(3, models.IntegerField()),
+        )
+
+class CollectionVersion(models.Model):
+    """Change counter per API collection, used to answer conditional GETs without serializing."""
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+
+def bump_collection_version(*names):
+    """
+    Mark collections as changed once the current transaction commits.
+
+    Bumping after commit keeps the version row out of the checkout's lock set, so
+    concurrent orders do not queue behind it.
+    """
+    def bump():
+        now = timezone.now()
+        for name in names:
+            if not CollectionVersion.objects.filter(name=name).update(version=F('version') + 1, updated_at=now):
+                try:
+                    with transaction.atomic():
+                        CollectionVersion.objects.create(name=name, version=1, updated_at=now)
+                except IntegrityError:
+                    CollectionVersion.objects.filter(name=name).update(version=F('version') + 1, updated_at=now)
+    transaction.on_commit(bump)
+
+
+class ChangeJournal(models.Model):
+    """Append-only feed of row changes; the id is the monotonic token offline clients sync from."""
+    ACTION_CHOICES = [
+        ('created', 'created'),
+        ('updated', 'updated'),
+        ('deleted', 'deleted'),
+    ]
+
+    model_name = models.CharField(max_length=30)
+    object_id = models.PositiveBigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.id}: {self.action} {self.model_name} {self.object_id}"
+
+
+def record_changes(model_name, object_ids, action='updated'):
+    """
+    Journal a change to several rows of one model once the current transaction commits.
+
+    The entries are inserted after the commit, in a short transaction of their own,
+    so they take their ids just before they become visible. Inserted during a long
+    transaction (a whole order batch), they would hold ids below those of changes
+    committed in the meantime, which clients may already have synced past.
+    """
+    object_ids = list(object_ids)
+    if object_ids:
+        transaction.on_commit(lambda: write_changes(model_name, object_ids, action))
+
+
+def write_changes(model_name, object_ids, action):
+    now = timezone.now()
+    with transaction.atomic():
+        ChangeJournal.objects.bulk_create(
+            [ChangeJournal(model_name=model_name, object_id=object_id, action=action, changed_at=now) for object_id in object_ids],
+            batch_size=1000,
+        )
+
+
+def record_product_changes(product_ids):
+    """For set-based product updates, which send no signals: journal them and bump the list version."""
+    product_ids = list(product_ids)
+    if product_ids:
+        record_changes('product', product_ids)
+        bump_collection_version('products')
+
+
+class IdempotencyKey(models.Model):
+    """A client-chosen key for one POST and the response it got, so a retry can be answered without re-running it."""
+    key = models.CharField(max_length=255)
+    user = models.ForeignKey(UserAccount, on_delete=models.CASCADE)
+    endpoint = models.CharField(max_length=100)
+    request_hash = models.CharField(max_length=64)
+    # Null while the first request is still running
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(encoder=DjangoJSONEncoder, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['user', 'endpoint', 'key'], name='unique_idempotency_key')
+        ]
+        indexes = [
+            models.Index(fields=['expires_at'], name='idempotency_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.endpoint} {self.key}"
+
+
+class AuditOutboxEvent(models.Model):
+    """
+    An order log / report write queued by a checkout in outbox mode.
+
+    `drain_audit_outbox` turns the events into OrderLog and Report rows in batches.
+    """
+    KIND_CHOICES = [
+        ('order_created', 'order_created'),
+        ('order_log', 'order_log'),
+        ('order_report', 'order_report'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.kind} {self.id}"
+
+
+class StockMovement(models.Model):
+    """
+    One change to a product's stock: positive quantities came in, negative ones went out.
+
+    The ledger is append-only. From the opening balances on, the movements of a
+    product add up to its stock, which is what point-in-time queries rely on.
+    `unit_cost` is what the units were valued at by post_stock_costs; only
+    `manage.py recompute_costs` revalues it.
+    """
+    REASON_CHOICES = [
+        ('opening', 'opening'),
+        ('sale', 'sale'),
+        ('edit', 'edit'),
+        ('delete', 'delete'),
+        ('purchase', 'purchase'),
+        ('adjustment', 'adjustment'),
+        ('stocktake', 'stocktake'),
+    ]
+
+    product = models.ForeignKey(Product, related_name='movements', on_delete=models.CASCADE)
+    quantity = models.IntegerField()
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    # The row that caused the movement, e.g. ('purchase_line', 12)
+    source_model = models.CharField(max_length=30, null=True, blank=True)
+    source_id = models.PositiveBigIntegerField(null=True, blank=True)
+    unit_cost = models.DecimalField(max_digits=20, decimal_places=6, null=True, blank=True)
+    user = models.CharField(max_length=255, default="User", null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'created_at', 'id'], name='stock_movement_product_idx'),
+            models.Index(fields=['created_at', 'id'], name='stock_movement_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.quantity:+d} ({self.reason})"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Stock movements are append-only; record a correcting movement instead.")
+        super().save(*args, **kwargs)
+
+
+class StockSnapshot(models.Model):
+    """A product's stock at `as_of`, summed from the ledger so point-in-time queries start from it."""
+    product = models.ForeignKey(Product, related_name='snapshots', on_delete=models.CASCADE)
+    as_of = models.DateTimeField()
+    quantity = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['as_of', 'product'], name='unique_stock_snapshot')
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} @ {self.as_of}: {self.quantity}"
+
+
+class CostLayer(models.Model):
+    """
+    Units of a product still in stock from one receipt, at the unit cost they came in at.
+
+    Stock leaves through the oldest layers first. A layer is deleted once it is
+    used up, so the layers of a product add up to the stock it has on hand.
+    """
+    product = models.ForeignKey(Product, related_name='cost_layers', on_delete=models.CASCADE)
+    received_at = models.DateTimeField(default=timezone.now)
+    remaining = models.PositiveIntegerField()
+    unit_cost = models.DecimalField(max_digits=20, decimal_places=6)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'received_at', 'id'], name='cost_layer_fifo_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}: {self.remaining} @ {self.unit_cost}"
+
+
+UNIT_COST = Decimal('0.000001')
+
+
+def fallback_unit_cost(average_cost, buying_price):
+    """Unit cost of stock no cost layer accounts for: the running average, else the buying price."""
+    if average_cost is not None:
+        return average_cost
+    return buying_price if buying_price is not None else Decimal('0')
+
+
+def take_from_layers(quantities):
+    """
+    Take {product_id: quantity} out of each product's oldest cost layers.
+
+    Returns {product_id: (units covered, their cost)}. A running total over each
+    product's layers stops the read at the layer that covers the rest of the
+    quantity, and used up layers are deleted, so no layer is passed over twice.
+    """
+    needed = Case(
+        *[When(product_id=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+        default=Value(0),
+        output_field=models.IntegerField(),
+    )
+    layers = (
+        CostLayer.objects.filter(product_id__in=quantities)
+        .annotate(before=Window(Sum('remaining'), partition_by=[F('product_id')], order_by=[F('received_at').asc(), F('id').asc()]) - F('remaining'))
+        .filter(before__lt=needed)
+        .order_by('product_id', 'received_at', 'id')
+    )
+    taken = {}
+    used_up = []
+    partly_used = []
+    for layer in layers:
+        covered, cost = taken.get(layer.product_id, (0, Decimal('0')))
+        units = min(layer.remaining, quantities[layer.product_id] - covered)
+        taken[layer.product_id] = (covered + units, cost + units * layer.unit_cost)
+        if units == layer.remaining:
+            used_up.append(layer.pk)
+        else:
+            layer.remaining -= units
+            partly_used.append(layer)
+    CostLayer.objects.filter(pk__in=used_up).delete()
+    CostLayer.objects.bulk_update(partly_used, ['remaining'])
+    return taken
+
+
+def post_stock_costs(movements):
+    """
+    Value unsaved StockMovements and post them to the cost layers and running averages.
+
+    Runs after the stock UPDATE the movements record, whose row locks keep
+    concurrent postings for a product apart. An incoming movement keeps the
+    unit_cost it was given (a purchase, or units returned at what they were sold
+    at) or is valued at the product's current unit cost; it adds a cost layer and
+    moves the running average. An outgoing movement takes its units from the
+    oldest layers and is valued at their cost under COSTING_METHOD = "fifo", or at
+    the running average under "average". A posting reads and writes a bounded
+    number of rows per product, so it costs O(1) amortized per movement.
+    """
+    if not movements:
+        return
+    products = {
+        product_id: (stock, fallback_unit_cost(average_cost, buying_price), average_cost)
+        for product_id, stock, average_cost, buying_price in Product.objects.filter(
+            pk__in={movement.product_id for movement in movements}
+        ).values_list('id', 'stock', 'average_cost', 'buying_price')
+    }
+    incoming = defaultdict(lambda: [0, Decimal('0')])
+    outgoing = defaultdict(int)
+    for movement in movements:
+        if movement.quantity > 0:
+            if movement.unit_cost is None:
+                movement.unit_cost = products[movement.product_id][1]
+            incoming[movement.product_id][0] += movement.quantity
+            incoming[movement.product_id][1] += movement.quantity * movement.unit_cost
+        elif movement.quantity < 0:
+            outgoing[movement.product_id] -= movement.quantity
+
+    taken = take_from_layers(outgoing) if outgoing else {}
+    for movement in movements:
+        if movement.quantity < 0:
+            fallback = products[movement.product_id][1]
+            if settings.COSTING_METHOD == 'average':
+                movement.unit_cost = fallback
+                continue
+            # Units no layer covers (stock counted in without a cost) go at the fallback cost
+            quantity = outgoing[movement.product_id]
+            covered, cost = taken.get(movement.product_id, (0, Decimal('0')))
+            movement.unit_cost = ((cost + (quantity - covered) * fallback) / quantity).quantize(UNIT_COST)
+
+    CostLayer.objects.bulk_create([
+        CostLayer(product_id=movement.product_id, received_at=movement.created_at, remaining=movement.quantity, unit_cost=movement.unit_cost)
+        for movement in movements if movement.quantity > 0
+    ])
+    averages = []
+    for product_id, (units, cost) in incoming.items():
+        stock, fallback, average_cost = products[product_id]
+        before = stock - units
+        average = cost / units if average_cost is None or before <= 0 else (before * average_cost + cost) / stock
+        averages.append(Product(pk=product_id, average_cost=average.quantize(UNIT_COST)))
+    Product.objects.bulk_update(averages, ['average_cost'])
+
+
 class ExpenseTypes(models.Model):
     name = models.CharField(max_length=100)
     user = models.CharField(max_length=255, default="User", null=True, blank=True)
@@ -202,13 +719,17 @@ class PurchaseExpense(models.Model):
     unpaid_amount = models.DecimalField(max_digits=20, decimal_places=2, default=0.00, null=True, blank=True)
     user = models.CharField(max_length=255, default="User", null=True, blank=True)
 
+    def set_totals(self, sub_total):
+        """ Sets sub-total, VAT and total from the sum of the line prices. """
+        self.sub_total = sub_total
+        vat_rate = Decimal('0.15')
+        self.vat = self.sub_total * vat_rate
+        self.total = self.sub_total + self.vat
+
     def update_totals(self):
         """ Updates total amounts based on related PurchaseProduct instances. """
         if self.pk:  # Ensure the instance is saved first
-            self.sub_total = self.products.aggregate(Sum('total_price'))['total_price__sum'] or 0.00
-            vat_rate = Decimal('0.15')
-            self.vat = self.sub_total * vat_rate
-            self.total = self.sub_total + self.vat
+            self.set_totals(self.products.aggregate(Sum('total_price'))['total_price__sum'] or Decimal('0.00'))
             self.save(update_fields=['sub_total', 'vat', 'total'])  # Prevent infinite recursion
    
     def update_payment_amount(self):
@@ -228,14 +749,14 @@ class PurchaseExpense(models.Model):
             self.unpaid_amount = Decimal('0.00')
 
     def save(self, *args, **kwargs):
-        """ First save instance, then update fields to avoid data loss. """
-        if not self.pk:  # If object is not yet saved
-            super().save(*args, **kwargs)  # Save first
-        
-        self.update_payment_amount()  # Update values
+        """ Works out the payment amounts from the total, then saves once. """
+        self.update_payment_amount()
 
-        # Save again only if there are changes
-        super().save(update_fields=['paid_amount', 'unpaid_amount'])
+        # A partial save also writes the payment amounts it may have changed
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'paid_amount', 'unpaid_amount'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.user} - {self.total}"
@@ -248,6 +769,8 @@ class PurchaseProduct(models.Model):
     unit_price = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
     total_price = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
     expense = models.ForeignKey('PurchaseExpense', related_name='products', on_delete=models.CASCADE, null=True, blank=True)
+    # The catalogue product this line restocks; lines without one are expenses only
+    stock_product = models.ForeignKey(Product, related_name='purchase_lines', on_delete=models.SET_NULL, null=True, blank=True)
 
     def save(self, *args, **kwargs):
         self.total_price = self.quantity * self.unit_price
@@ -268,26 +791,184 @@ def set_order_item_price(sender, instance, **kwargs):
 
 @receiver(pre_save, sender=OrderItem)
 def set_order_item_cost(sender, instance, **kwargs):
-    """Calculate price before saving the OrderItem instance."""
+    """Cost an item saved outside the order code (e.g. in the admin) at the product's buying price."""
+    if getattr(instance, '_costed', False):
+        return
     instance.cost = instance.get_cost()
 
-@receiver([post_save, post_delete], sender=OrderItem)
-def update_order_total(sender, instance, **kwargs):
-    """Update total amount in Order when an OrderItem is added, updated, or deleted."""
-    order = instance.order
-    order.total_amount = order.get_total_price()
-    order.save()
+@receiver(pre_save, sender=OrderItem)
+def remember_order_item_values(sender, instance, **kwargs):
+    """Make sure the previously stored figures are known before an existing item is saved."""
+    if instance.pk and not hasattr(instance, '_stored'):
+        instance._stored = OrderItem.objects.filter(pk=instance.pk).values(*OrderItem.SALES_FIELDS).first()
+
+@receiver(post_save, sender=OrderItem)
+def update_order_total(sender, instance, created, **kwargs):
+    """Apply the change in this item's price to its order's total and the sales rollup."""
+    previous = None if created else instance._stored
+    current = instance.sales_snapshot()
+    previous_price = Decimal(previous['price'] or 0) if previous else Decimal('0.00')
+    apply_order_total_delta(instance.order_id, Decimal(current['price'] or 0) - previous_price)
+
+    deltas = {}
+    if previous:
+        add_item_sales(deltas, instance.order, previous, -1, product_category_id(previous['product_id']))
+    add_item_sales(deltas, instance.order, current, 1, instance.product.category_id if instance.product else None)
+    apply_sales_rollup(deltas)
+    instance._stored = current
 
-@receiver([post_save, post_delete], sender=OrderItem)
-def update_order_total(sender, instance, **kwargs):
-    order = instance.order
-    total = sum(item.quantity * item.product.selling_price for item in order.items.all())
-    order.total_amount = total
-    order.save()
+@receiver(post_delete, sender=OrderItem)
+def remove_from_order_total(sender, instance, **kwargs):
+    """Take a deleted item off its order's total and the sales rollup."""
+    if getattr(instance, '_edited_in_bulk', False):
+        # update_order adjusts the total and rollup once for all the items it removes
+        return
+    previous = getattr(instance, '_stored', None) or instance.sales_snapshot()
+    apply_order_total_delta(instance.order_id, -Decimal(previous['price'] or 0))
+
+    order = Order.objects.filter(pk=instance.order_id).first()
+    if order:
+        deltas = {}
+        add_item_sales(deltas, order, previous, -1, product_category_id(previous['product_id']))
+        apply_sales_rollup(deltas)
 
 @receiver(post_delete, sender=OrderItem)
 def delete_order_if_no_items(sender, instance, **kwargs):
+    if getattr(instance, '_edited_in_bulk', False):
+        return
     # Check if the associated order has any items left
     order = instance.order
     if not order.items.exists():  # Check if the related items queryset is empty
-        order.delete()
\ No newline at end of file
+        order.delete()
+
+
+@receiver(pre_save, sender=Product)
+def remember_stored_stock(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'stock' in update_fields:
+        instance._stored_stock = Product.objects.filter(pk=instance.pk).values_list('stock', flat=True).first() if instance.pk else None
+
+@receiver(post_save, sender=Product)
+def record_stock_count(sender, instance, created, update_fields=None, **kwargs):
+    """Enter a stock figure typed in on the product (create, edit, admin) in the ledger as a stocktake."""
+    if not hasattr(instance, '_stored_stock') or not isinstance(instance.stock, int):
+        return
+    change = instance.stock - (instance._stored_stock or 0)
+    del instance._stored_stock
+    if change:
+        movement = StockMovement(product=instance, quantity=change, reason='stocktake', user=instance.user)
+        post_stock_costs([movement])
+        movement.save()
+
+
+@receiver(pre_delete, sender=Order)
+def release_order_reservations(sender, instance, **kwargs):
+    # The cascade removes the reservation rows but not the units they hold on the products.
+    # The rows are deleted here too, since deleting the last item deletes the order a second time.
+    held = dict(instance.reservations.values_list('product_id', 'quantity'))
+    for product_id in sorted(held):
+        Product.objects.filter(pk=product_id).update(reserved=F('reserved') - held[product_id])
+    instance.reservations.all().delete()
+    record_product_changes(held)
+
+
+# Cleared once the change is committed; clearing earlier would let a concurrent
+# request cache the list as it was before the change, for REFERENCE_CACHE_TIMEOUT
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_cached_categories(sender, **kwargs):
+    transaction.on_commit(lambda: invalidate_reference_list('categories'))
+
+@receiver([post_save, post_delete], sender=Supplier)
+def invalidate_cached_suppliers(sender, **kwargs):
+    transaction.on_commit(lambda: invalidate_reference_list('suppliers'))
+
+@receiver([post_save, post_delete], sender=ExpenseTypes)
+def invalidate_cached_expense_types(sender, **kwargs):
+    transaction.on_commit(lambda: invalidate_reference_list('expense_types'))
+
+@receiver([post_save, post_delete], sender=CompanyInfo)
+def invalidate_cached_company(sender, **kwargs):
+    transaction.on_commit(lambda: invalidate_reference_list('company'))
+
+
+# Collections whose serialized lists embed data from each model; order lines show
+# their product's selling price
+COLLECTIONS_BY_MODEL = {
+    Product: ('products', 'orders'),
+    Category: ('products',),
+    Supplier: ('products',),
+    CustomerInfo: ('customers', 'orders'),
+    Order: ('orders',),
+    OrderItem: ('orders',),
+}
+
+@receiver([post_save, post_delete])
+def bump_collection_versions(sender, **kwargs):
+    if getattr(kwargs.get('instance'), '_edited_in_bulk', False):
+        # Part of an order edit, which bumps the orders collection once itself
+        return
+    names = COLLECTIONS_BY_MODEL.get(sender)
+    if names:
+        bump_collection_version(*names)
+
+
+# Models mirrored by offline POS clients through the sync feed
+SYNCED_MODELS = {
+    Product: 'product',
+    CustomerInfo: 'customer',
+    Category: 'category',
+    Supplier: 'supplier',
+}
+
+@receiver(post_save)
+def journal_saved_row(sender, instance, created, **kwargs):
+    model_name = SYNCED_MODELS.get(sender)
+    if not model_name:
+        return
+    record_changes(model_name, [instance.pk], 'created' if created else 'updated')
+    if sender in (Category, Supplier) and not created:
+        # Products embed the category and supplier names
+        field = 'category' if sender is Category else 'supplier'
+        record_changes('product', Product.objects.filter(**{field: instance}).values_list('id', flat=True))
+
+@receiver(pre_delete)
+def journal_orphaned_products(sender, instance, **kwargs):
+    # Deleting a category or supplier nulls the products' foreign key without sending their signals
+    if sender in (Category, Supplier):
+        field = 'category' if sender is Category else 'supplier'
+        record_changes('product', Product.objects.filter(**{field: instance}).values_list('id', flat=True))
+
+@receiver(post_delete)
+def journal_deleted_row(sender, instance, **kwargs):
+    model_name = SYNCED_MODELS.get(sender)
+    if model_name:
+        record_changes(model_name, [instance.pk], 'deleted')
+
+
+# Image fields that get resized derivatives (see images.py)
+IMAGE_FIELDS = {
+    Product: 'image',
+    CompanyInfo: 'logo',
+    UserAccount: 'profile_image',
+}
+
+@receiver(pre_save)
+def remember_image_upload(sender, instance, **kwargs):
+    field = IMAGE_FIELDS.get(sender)
+    if field:
+        # A file that is not committed yet is a new upload, written to storage during this save
+        image = getattr(instance, field)
+        instance._image_uploaded = bool(image) and not image._committed
+
+@receiver(post_save)
+def generate_image_derivatives(sender, instance, **kwargs):
+    if sender in IMAGE_FIELDS and getattr(instance, '_image_uploaded', False):
+        instance._image_uploaded = False
+        queue_derivatives(getattr(instance, IMAGE_FIELDS[sender]), on_done=derivatives_ready(sender, instance.pk))
+
+def derivatives_ready(sender, pk):
+    """Refresh what caches the derivative URLs of a row once they exist."""
+    if sender is Product:
+        return lambda: record_product_changes([pk])
+    if sender is CompanyInfo:
+        return lambda: invalidate_reference_list('company')
+    return None
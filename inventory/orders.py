@@ -0,0 +1,374 @@
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import transaction
+from django.db.models.deletion import Collector
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from rest_framework import serializers
+from .models import Order, OrderItem, OrderLog, Report, Product, add_item_sales, apply_order_total_delta, apply_sales_rollup, bump_collection_version
+from .stock import apply_stock_deltas, apply_reservation_deltas, record_stock_movements
+from .reservations import create_reservations, apply_order_stock_deltas, fulfil_order_hold, release_order_hold
+from .costing import current_unit_costs, line_cost, order_line_costs, returned_unit_costs
+from .audit import outbox_enabled, enqueue, order_created_payload
+
+VAT_RATE = Decimal('0.15')
+CENT = Decimal('0.01')
+MAX_ORDER_BATCH = 1000
+
+
+def line_total(product, quantity):
+    """Price of an order line, VAT included when the product is sold with a receipt."""
+    total = product.selling_price * quantity
+    if product.receipt:
+        total += total * VAT_RATE
+    # Rounded like the DecimalField column, so totals add up the stored line prices
+    return total.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def validate_order_lines(items_data):
+    """
+    Check every line of an order before anything is written.
+
+    Quantities of repeated products are added up so the stock engine sees the whole
+    order. Errors are reported per line in the same shape DRF uses for nested lists.
+    """
+    errors = [{} for _ in items_data]
+    requested = defaultdict(int)
+    for index, item_data in enumerate(items_data):
+        if item_data['quantity'] <= 0:
+            errors[index]['quantity'] = ["Quantity must be greater than zero."]
+        else:
+            requested[item_data['product'].pk] += item_data['quantity']
+
+    if any(errors):
+        raise serializers.ValidationError({'items': errors})
+    return requested
+
+
+def take_order_stock(items_data, requested, apply=apply_stock_deltas):
+    """
+    Decrement stock for all of an order's products, reporting shortages per line.
+
+    Pending orders pass apply_reservation_deltas to hold the stock instead.
+    """
+    shortages = apply(requested)
+    if shortages:
+        raise_shortages(items_data, shortages, requested)
+
+
+def raise_shortages(items_data, shortages, requested):
+    """Report {product_id: available_stock} shortages on the order lines of those products."""
+    errors = [{} for _ in items_data]
+    for index, item_data in enumerate(items_data):
+        product = item_data['product']
+        if product.pk in shortages:
+            errors[index]['quantity'] = [
+                f"Insufficient stock for {product.name}. Available stock is {shortages[product.pk]}, "
+                f"but {requested[product.pk]} was requested."
+            ]
+    raise serializers.ValidationError({'items': errors})
+
+
+def create_order(validated_data, user_name):
+    """
+    Write an order and all of its lines in one transaction.
+
+    Items, log rows and report rows are inserted with bulk_create, which skips the
+    per-item OrderItem signals, so price, cost, receipt and the order total are
+    computed here once instead of being re-summed after every line. With
+    ORDER_AUDIT_MODE = "outbox" the log and report rows are replaced by a single
+    queued event. A Pending order only holds its stock until it is completed or
+    its reservation expires. Lines are costed at what their sale took out of
+    stock (see post_stock_costs).
+    """
+    items_data = validated_data.pop('items')
+    validated_data['user'] = user_name
+    if validated_data.get('status') == 'Expired':
+        raise serializers.ValidationError({'status': ["An order cannot be placed as Expired."]})
+    pending = validated_data.get('status') == 'Pending'
+
+    with transaction.atomic():
+        requested = validate_order_lines(items_data)
+        take_order_stock(items_data, requested, apply_reservation_deltas if pending else apply_stock_deltas)
+
+        prices = [line_total(item_data['product'], item_data['quantity']) for item_data in items_data]
+        validated_data['total_amount'] = sum(prices, Decimal('0.00'))
+        order = Order.objects.create(**validated_data)
+        if pending:
+            unit_costs = current_unit_costs(requested)
+        else:
+            movements = record_stock_movements({product_id: -quantity for product_id, quantity in requested.items()}, 'sale', 'order', order.id, user_name)
+            unit_costs = {product_id: movement.unit_cost for product_id, movement in movements.items()}
+
+        items = []
+        logs = []
+        reports = []
+        lines = []
+        customer = order.customer
+        audit_in_outbox = outbox_enabled()
+        for item_data, price in zip(items_data, prices):
+            product = item_data['product']
+            quantity = item_data['quantity']
+            items.append(OrderItem(
+                order=order,
+                product=product,
+                quantity=quantity,
+                price=price,
+                cost=line_cost(unit_costs[product.pk], quantity),
+                receipt=product.receipt or item_data.get('receipt', False),
+            ))
+            if audit_in_outbox:
+                lines.append((product, quantity, price))
+                continue
+            logs.append(OrderLog(
+                user=user_name,
+                action="Create",
+                model_name="Order",
+                object_id=order.id,
+                customer_info=customer,
+                product_name=product.name,
+                quantity=quantity,
+                price=price,
+                changes_on_update="Created Order Item",
+            ))
+            reports.append(Report(
+                user=user_name,
+                customer_name=customer.name if customer else "Anonymous Customer",
+                customer_phone=customer.phone if customer else "0000000000",
+                customer_tin_number=customer.tin_number if customer else "1111",
+                order_date=order.order_date,
+                product_name=product.name,
+                product_price=product.selling_price,
+                quantity=quantity,
+                price=price,
+            ))
+
+        OrderItem.objects.bulk_create(items)
+        if pending:
+            create_reservations(order, requested)
+        if audit_in_outbox:
+            # One event row instead of two rows per line; drain_audit_outbox writes them later
+            enqueue('order_created', order_created_payload(order, customer, lines))
+        else:
+            OrderLog.objects.bulk_create(logs)
+            Report.objects.bulk_create(reports)
+
+        deltas = {}
+        for item in items:
+            add_item_sales(deltas, order, item.sales_snapshot(), 1, item.product.category_id)
+        apply_sales_rollup(deltas)
+        bump_collection_version('orders')
+    return order
+
+
+def change_order_status(order, status, editing_items):
+    """Move a Pending order's held stock along with its status (see reservations.py)."""
+    previous = order.status
+    if (previous == 'Expired' and status != 'Expired') or (editing_items and 'Expired' in (previous, status)):
+        raise serializers.ValidationError({'status': ["The stock held for this order has expired. Place a new order."]})
+    if previous == 'Pending' and status == 'Expired':
+        release_order_hold(order)
+    elif previous == 'Pending' and status != 'Pending':
+        # Completing a Pending order sells the stock it held
+        fulfil_order_hold(order)
+    order.status = status
+
+
+def update_order(order, validated_data, partial=False):
+    """
+    Apply an edit to an order and its lines in one transaction.
+
+    `items` gives the wanted quantity per product. It is compared with the order's
+    items in memory: new products are added, changed quantities are updated and,
+    unless the edit is partial, items of products left out are removed. The items
+    and their products are read with one query, stock for every changed product
+    moves in one statement per direction, and items are written with bulk
+    operations that skip the OrderItem signals, so the order total and the sales
+    rollup are adjusted once by the difference instead of after every line.
+    An empty `items` leaves the lines alone.
+    """
+    items_data = validated_data.get('items') or []
+
+    with transaction.atomic():
+        change_order_status(order, validated_data.get('status', order.status), bool(items_data))
+        order.customer = validated_data.get('customer', order.customer)
+        order.save(update_fields=['customer', 'status'])
+        if not items_data:
+            return order
+
+        requested = validate_order_lines(items_data)
+        existing = defaultdict(list)
+        products = {}
+        for item in order.items.select_related('product'):
+            existing[item.product_id].append(item)
+            products[item.product_id] = item.product
+        products.update((item_data['product'].pk, item_data['product']) for item_data in items_data)
+
+        deltas = {}
+        stored = {}
+        for product_id in (set(requested) | set(existing)) - {None}:
+            items = existing.get(product_id, [])
+            stored[product_id] = (sum(item.quantity for item in items), sum((item.cost or Decimal('0.00') for item in items), Decimal('0.00')))
+            wanted = requested.get(product_id, stored[product_id][0] if partial else 0)
+            if wanted != stored[product_id][0]:
+                deltas[product_id] = wanted - stored[product_id][0]
+        shortages, movements = apply_order_stock_deltas(
+            order, deltas, removed=set(deltas) - set(requested), unit_costs=returned_unit_costs(stored, deltas),
+        )
+        if shortages:
+            raise_shortages(items_data, shortages, requested)
+        costs = order_line_costs(stored, deltas, movements)
+
+        created, changed, removed = [], [], []
+        for product_id, quantity in requested.items():
+            items = existing.get(product_id)
+            product = products[product_id]
+            if not items:
+                created.append(OrderItem(
+                    order=order,
+                    product=product,
+                    quantity=quantity,
+                    price=line_total(product, quantity),
+                    cost=costs[product_id],
+                    receipt=product.receipt,
+                ))
+                continue
+            # Repeated lines of a product are merged into its first item
+            item, repeats = items[0], items[1:]
+            removed.extend(repeats)
+            if item.quantity != quantity or repeats:
+                item.quantity = quantity
+                item.price = line_total(product, quantity)
+                item.cost = costs.get(product_id, stored[product_id][1])
+                item.receipt = item.receipt or product.receipt
+                changed.append(item)
+        if not partial:
+            for product_id, items in existing.items():
+                if product_id not in requested:
+                    removed.extend(items)
+
+        OrderItem.objects.bulk_create(created)
+        OrderItem.objects.bulk_update(changed, ['quantity', 'price', 'cost', 'receipt'])
+        if removed:
+            for item in removed:
+                item._edited_in_bulk = True
+            # Deletes them in one statement; the receivers skip the flagged items
+            collector = Collector(using=OrderItem.objects.db)
+            collector.collect(removed)
+            collector.delete()
+
+        sales = {}
+        total_delta = Decimal('0.00')
+        for item in changed + removed:
+            previous = item._stored
+            total_delta -= Decimal(previous['price'] or 0)
+            previous_product = products.get(previous['product_id'])
+            add_item_sales(sales, order, previous, -1, previous_product.category_id if previous_product else None)
+        for item in created + changed:
+            total_delta += item.price
+            add_item_sales(sales, order, item.sales_snapshot(), 1, item.product.category_id)
+        apply_sales_rollup(sales)
+        apply_order_total_delta(order.pk, total_delta)
+        order.total_amount += total_delta
+        for item in changed:
+            item._stored = item.sales_snapshot()
+    return order
+
+
+class OrderBatchSerializer(serializers.Serializer):
+    orders = serializers.ListField(child=serializers.DictField(), allow_empty=False, max_length=MAX_ORDER_BATCH)
+    all_or_nothing = serializers.BooleanField(default=False)
+
+
+def batch_product_ids(orders_data):
+    ids = set()
+    for order_data in orders_data:
+        items = order_data.get('items') if isinstance(order_data, dict) else None
+        for item in items if isinstance(items, list) else []:
+            if isinstance(item, dict) and str(item.get('product', '')).isdigit():
+                ids.add(int(item['product']))
+    return ids
+
+
+def submit_order(serializer_class, order_data, context):
+    """Validate and create one order of a batch; returns its result entry."""
+    serializer = serializer_class(data=order_data, context=context)
+    if not serializer.is_valid():
+        return {'status': 'error', 'errors': serializer.errors}
+    try:
+        order = serializer.save()
+    except serializers.ValidationError as e:
+        return {'status': 'error', 'errors': e.detail}
+    return {'status': 'created', 'id': order.id, 'total_amount': order.total_amount}
+
+
+def lock_batch_products(orders_data):
+    # Locked in id order, the same order apply_stock_deltas uses, so two batches
+    # in flight can never wait on each other's rows in a cycle
+    list(Product.objects.select_for_update().filter(pk__in=batch_product_ids(orders_data)).order_by('id').values_list('id'))
+
+
+def create_orders_batch(serializer_class, orders_data, context, all_or_nothing=False):
+    """
+    Create many orders in one request and report a result per order.
+
+    Each order is validated and saved through `serializer_class`, exactly as if it
+    had been posted on its own. By default every order has its own transaction, so
+    one bad order does not hold back the rest. With `all_or_nothing` the whole batch
+    is one transaction: every order is still tried so all errors can be reported,
+    but if any fails none is kept.
+
+    Whenever the orders share a transaction, the products of the whole batch are
+    locked up front, since the rows one order locks stay locked while the next
+    order runs.
+    """
+    results = []
+    if not all_or_nothing and not transaction.get_connection().in_atomic_block:
+        for index, order_data in enumerate(orders_data):
+            results.append({'index': index, **submit_order(serializer_class, order_data, context)})
+        return results
+
+    with transaction.atomic():
+        lock_batch_products(orders_data)
+        for index, order_data in enumerate(orders_data):
+            # A savepoint per order, so a failed order leaves the transaction usable
+            with transaction.atomic():
+                result = submit_order(serializer_class, order_data, context)
+                if result['status'] == 'error':
+                    transaction.set_rollback(True)
+            results.append({'index': index, **result})
+
+        if all_or_nothing and any(result['status'] == 'error' for result in results):
+            transaction.set_rollback(True)
+            for result in results:
+                if result['status'] == 'created':
+                    result.update(status='rolled_back', id=None)
+    return results
+
+
+def items_total_subquery():
+    """Sum of the item prices of the outer order, as a correlated subquery."""
+    totals = (
+        OrderItem.objects.filter(order=OuterRef('pk'))
+        .values('order')
+        .annotate(total=Sum('price'))
+        .values('total')
+    )
+    return Coalesce(Subquery(totals), Value(Decimal('0.00')), output_field=DecimalField(max_digits=10, decimal_places=2))
+
+
+def find_order_total_mismatches():
+    """Orders whose stored total differs from the sum of their items, found in one query."""
+    return (
+        Order.objects.annotate(items_total=items_total_subquery())
+        .exclude(total_amount=F('items_total'))
+        .values('id', 'total_amount', 'items_total')
+        .order_by('id')
+    )
+
+
+def repair_order_totals(order_ids):
+    """Reset the stored totals of the given orders to the sum of their items in one UPDATE."""
+    with transaction.atomic():
+        bump_collection_version('orders')
+        return Order.objects.filter(pk__in=order_ids).update(total_amount=items_total_subquery())
@@ -0,0 +1,76 @@
+from collections import defaultdict
+from decimal import Decimal
+from django.db import transaction
+from .models import PurchaseExpense, PurchaseProduct, StockMovement, post_stock_costs
+from .stock import receive_stock
+
+
+def receive_purchase_lines(expense, lines, update_buying_price=False):
+    """
+    Put the lines that reference a catalogue product into stock.
+
+    Stock for all of the products goes up in one UPDATE, and one StockMovement per
+    line records the delivery at its unit price, which is also the cost of the
+    layer it adds for FIFO costing.
+    """
+    stocked = [line for line in lines if line.stock_product_id]
+    if not stocked:
+        return
+    if any(line.pk is None for line in stocked):
+        # Backends without INSERT ... RETURNING leave bulk-created rows without ids;
+        # one insert statement numbers them in order
+        ids = PurchaseProduct.objects.filter(expense=expense).order_by('id').values_list('id', flat=True)
+        for line, line_id in zip(lines, ids):
+            line.pk = line_id
+
+    received = defaultdict(lambda: [0, Decimal('0.00')])
+    for line in stocked:
+        received[line.stock_product_id][0] += line.quantity
+        received[line.stock_product_id][1] += line.total_price
+    receive_stock(received, weighted_cost=update_buying_price)
+    movements = [
+        StockMovement(
+            product_id=line.stock_product_id,
+            quantity=line.quantity,
+            reason='purchase',
+            source_model='purchase_line',
+            source_id=line.pk,
+            unit_cost=line.unit_price,
+            user=expense.user,
+        )
+        for line in stocked
+    ]
+    post_stock_costs(movements)
+    StockMovement.objects.bulk_create(movements)
+
+
+def create_purchase_expense(validated_data, products_data, update_buying_price=False):
+    """
+    Write a supplier invoice and all of its lines in one transaction.
+
+    Line prices, sub-total, VAT, total and the payment amounts are computed once
+    here and the lines are inserted with bulk_create, instead of every line's
+    save() re-summing the invoice and saving it again. The figures are the ones
+    PurchaseProduct.save and PurchaseExpense.update_totals would produce. An
+    invoice without lines keeps the totals it was posted with.
+
+    Lines that reference a product are received into stock (see
+    receive_purchase_lines); `update_buying_price` also moves those products'
+    buying price to the weighted average cost.
+    """
+    lines = [PurchaseProduct(**product_data) for product_data in products_data]
+    for line, product_data in zip(lines, products_data):
+        line.total_price = line.quantity * line.unit_price
+        if line.stock_product and 'product' not in product_data:
+            line.product = line.stock_product.name
+
+    with transaction.atomic():
+        expense = PurchaseExpense(**validated_data)
+        if lines:
+            expense.set_totals(sum((line.total_price for line in lines), Decimal('0.00')))
+        expense.save()
+        for line in lines:
+            line.expense = expense
+        PurchaseProduct.objects.bulk_create(lines)
+        receive_purchase_lines(expense, lines, update_buying_price)
+    return expense
@@ -0,0 +1,130 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+from .models import Order, StockReservation, bump_collection_version
+from .stock import apply_stock_deltas, apply_reservation_deltas, consume_reserved_stock, record_stock_movements
+from .costing import cost_sold_lines
+
+
+def reservation_expiry():
+    return timezone.now() + timedelta(hours=settings.STOCK_RESERVATION_TTL_HOURS)
+
+
+def create_reservations(order, held):
+    """Record the {product_id: quantity} already held on the products for a new Pending order."""
+    expires_at = reservation_expiry()
+    StockReservation.objects.bulk_create([
+        StockReservation(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at)
+        for product_id, quantity in held.items() if quantity > 0
+    ])
+
+
+def change_order_hold(order, deltas):
+    """
+    Hold more ({product_id: positive}) or less ({product_id: negative}) for a Pending order.
+
+    Added products share the expiry of the order's existing holds. Returns the
+    shortages reported by apply_reservation_deltas; the caller must roll back then.
+    """
+    shortages = apply_reservation_deltas(deltas)
+    if shortages:
+        return shortages
+
+    existing = {reservation.product_id: reservation for reservation in order.reservations.all()}
+    expires_at = min((reservation.expires_at for reservation in existing.values()), default=None) or reservation_expiry()
+    to_create, to_update, to_delete = [], [], []
+    for product_id, quantity in deltas.items():
+        reservation = existing.get(product_id)
+        if reservation is None:
+            if quantity > 0:
+                to_create.append(StockReservation(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at))
+        elif reservation.quantity + quantity > 0:
+            reservation.quantity += quantity
+            to_update.append(reservation)
+        else:
+            to_delete.append(reservation.pk)
+    StockReservation.objects.bulk_create(to_create)
+    StockReservation.objects.bulk_update(to_update, ['quantity'])
+    StockReservation.objects.filter(pk__in=to_delete).delete()
+    return {}
+
+
+def fulfil_order_hold(order):
+    """
+    Sell what a Pending order holds, when it is completed.
+
+    The reservation rows are locked before the products, the same order the sweeper
+    takes them in. Orders that were Pending before reservations existed hold
+    nothing; their stock was taken when they were placed. The lines, costed at an
+    estimate until now, are costed at what the sale took out of stock.
+    """
+    held = dict(order.reservations.select_for_update().values_list('product_id', 'quantity'))
+    if Order.objects.select_for_update().filter(pk=order.pk, status='Expired').exists():
+        raise serializers.ValidationError({'status': ["The stock held for this order has expired. Place a new order."]})
+    if not held:
+        return
+    if not consume_reserved_stock(held):
+        raise serializers.ValidationError({'items': ["Stock was lowered below what this order holds. Check the quantities and try again."]})
+    order.reservations.all().delete()
+    movements = record_stock_movements({product_id: -quantity for product_id, quantity in held.items()}, 'sale', 'order', order.pk, order.user)
+    cost_sold_lines(order, movements)
+
+
+def release_expired_reservations(batch_size=500):
+    """
+    Release up to `batch_size` expired holds and return how many were released.
+
+    The holds are given back with one UPDATE per product and deleted in one
+    statement. Pending orders left holding nothing become Expired. Holds locked by
+    a checkout that is completing them are skipped where the database supports it.
+    """
+    with transaction.atomic():
+        rows = list(
+            StockReservation.objects.select_for_update(skip_locked=True)
+            .filter(expires_at__lte=timezone.now()).order_by('expires_at', 'id')
+            .values_list('id', 'order_id', 'product_id', 'quantity')[:batch_size]
+        )
+        if not rows:
+            return 0
+        released = defaultdict(int)
+        for reservation_id, order_id, product_id, quantity in rows:
+            released[product_id] -= quantity
+        apply_reservation_deltas(released)
+        StockReservation.objects.filter(pk__in=[row[0] for row in rows]).delete()
+
+        expired = Order.objects.filter(
+            pk__in={row[1] for row in rows}, status='Pending', reservations__isnull=True
+        ).update(status='Expired')
+        if expired:
+            bump_collection_version('orders')
+    return len(rows)
+
+
+def release_order_hold(order):
+    """Give back everything a Pending order holds, when it is cancelled by marking it Expired."""
+    held = dict(order.reservations.values_list('product_id', 'quantity'))
+    change_order_hold(order, {product_id: -quantity for product_id, quantity in held.items()})
+
+
+def apply_order_stock_deltas(order, deltas, removed=(), unit_costs=None):
+    """
+    Apply a change to an order's quantities to the stock the order affects: the
+    holds of an order that holds stock, the stock itself otherwise.
+
+    Stock changes are entered in the ledger as edits, or as deletes for the
+    products in `removed` whose lines were taken off the order; units given back
+    come in at `unit_costs`. Returns (shortages, {product_id: movement}).
+    """
+    if order.status == 'Pending' and order.reservations.exists():
+        return change_order_hold(order, deltas), {}
+    shortages = apply_stock_deltas(deltas)
+    movements = {}
+    if not shortages:
+        for reason, product_ids in (('edit', set(deltas) - set(removed)), ('delete', set(deltas) & set(removed))):
+            movements.update(record_stock_movements(
+                {product_id: -deltas[product_id] for product_id in product_ids}, reason, 'order', order.pk, order.user, unit_costs,
+            ))
+    return shortages, movements
@@ -0,0 +1,81 @@
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum, Count
+from django.db.models.functions import TruncDate, TruncMonth, TruncWeek
+from .models import DailySalesRollup, OrderItem
+from .utils import parse_date_param
+
+GRANULARITIES = {
+    'day': F('date'),
+    'week': TruncWeek('date'),
+    'month': TruncMonth('date'),
+}
+
+
+def filter_sales_rollup(params):
+    """Rollup rows limited by the optional `from` / `to` dates of a request."""
+    rows = DailySalesRollup.objects.all()
+    date_from = parse_date_param(params, 'from')
+    date_to = parse_date_param(params, 'to')
+    if date_from:
+        rows = rows.filter(date__gte=date_from)
+    if date_to:
+        rows = rows.filter(date__lte=date_to)
+    return rows
+
+
+def sales_series(rows, granularity):
+    """Revenue, cost, profit and quantity per day, week or month."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"'granularity' must be one of {', '.join(GRANULARITIES)}.")
+    return (
+        rows.annotate(period=GRANULARITIES[granularity])
+        .values('period')
+        .annotate(
+            total_revenue=Sum('revenue'),
+            total_cost=Sum('cost'),
+            total_profit=Sum(ExpressionWrapper(F('revenue') - F('cost'), output_field=DecimalField())),
+            total_quantity=Sum('quantity'),
+        )
+        .order_by('period')
+    )
+
+
+def rebuild_sales_rollup(date_from=None, date_to=None, batch_size=1000):
+    """
+    Recompute the rollup from OrderItem for a date range (everything by default).
+
+    The items are aggregated by the database in one grouped query and the rows are
+    written back with bulk inserts, replacing whatever the range held before.
+    """
+    items = OrderItem.objects.annotate(date=TruncDate('order__order_date'))
+    rollups = DailySalesRollup.objects.all()
+    if date_from:
+        items = items.filter(date__gte=date_from)
+        rollups = rollups.filter(date__gte=date_from)
+    if date_to:
+        items = items.filter(date__lte=date_to)
+        rollups = rollups.filter(date__lte=date_to)
+
+    grouped = (
+        items.values('date', 'product_id', 'product__category_id', 'order__user')
+        .annotate(revenue=Sum('price'), cost=Sum('cost'), quantity=Sum('quantity'), line_count=Count('id'))
+        .order_by()
+    )
+    with transaction.atomic():
+        rollups.delete()
+        rows = [
+            DailySalesRollup(
+                date=row['date'],
+                product_id=row['product_id'],
+                category_id=row['product__category_id'],
+                user=row['order__user'],
+                revenue=row['revenue'] or Decimal('0.00'),
+                cost=row['cost'] or Decimal('0.00'),
+                quantity=row['quantity'] or 0,
+                line_count=row['line_count'],
+            )
+            for row in grouped.iterator()
+        ]
+        DailySalesRollup.objects.bulk_create(rows, batch_size=batch_size)
+    return len(rows)
@@ -1,11 +1,16 @@
 from rest_framework import serializers
-from .models import Product, Supplier, Order, OrderItem, CustomerInfo,  Category, CompanyInfo, OrderLog, Report, ExpenseTypes, OtherExpenses, Performa, PurchaseExpense, PurchaseProduct
+from .models import Product, Supplier, Order, OrderItem, CustomerInfo,  Category, CompanyInfo, OrderLog, Report, ExpenseTypes, OtherExpenses, Performa, PurchaseExpense, PurchaseProduct, StockMovement
 from django.db import transaction
 from django.core.exceptions import ValidationError
 from django.db.models import UniqueConstraint
 from user.models import UserAccount
 from user.serializers import UserSerializer
-from .utils import create_order_log, create_order_report
+from .orders import create_order, update_order, batch_product_ids
+from .costing import order_line_costs, returned_unit_costs
+from .purchases import create_purchase_expense
+from .reservations import apply_order_stock_deltas
+from .images import ImageDerivativesField
+from .sparse import SparseFieldsMixin
 from decimal import Decimal
 
 
@@ -32,13 +37,15 @@ class SupplierSerializer(serializers.ModelSerializer):
             validated_data['user'] = user.name
         return super().create(validated_data)
 
-class ProductGetSerializer(serializers.ModelSerializer):
+class ProductGetSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
     supplier_name = serializers.CharField(source='supplier.name', read_only=True)
+    image_derivatives = ImageDerivativesField(source='image')
+    available_stock = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'category_name', 'description', 'buying_price', 'selling_price', 'receipt', 'stock', 'supplier_name', 'image', 'user']
+        fields = ['id', 'name', 'category_name', 'description', 'buying_price', 'selling_price', 'receipt', 'stock', 'supplier_name', 'image', 'image_derivatives', 'user', 'reorder_point', 'reorder_quantity', 'is_low_stock', 'reserved', 'available_stock']
         constraints = [
             UniqueConstraint(fields=['name', 'category_name'], name='unique_product_category')
         ]
@@ -48,6 +55,9 @@ class ProductPostSerializer(serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = '__all__'
+        # reserved is only moved by Pending orders (see reservations.py), average_cost
+        # by stock costing (see post_stock_costs); is_low_stock is computed by the database
+        read_only_fields = ['reserved', 'average_cost', 'is_low_stock']
         constraints = [
             UniqueConstraint(fields=['name', 'category'], name='unique_product_category')
         ]
@@ -58,7 +68,7 @@ class ProductPostSerializer(serializers.ModelSerializer):
             validated_data['user'] = user.name
         return super().create(validated_data)
 
-class CustomerInfoSerializer(serializers.ModelSerializer):
+class CustomerInfoSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = CustomerInfo
         fields = '__all__'
@@ -70,6 +80,8 @@ class CustomerInfoSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 class CompanyInfoSerializer(serializers.ModelSerializer):
+    logo_derivatives = ImageDerivativesField(source='logo')
+
     class Meta:
         model = CompanyInfo
         fields = '__all__'
@@ -83,8 +95,18 @@ class CompanyInfoSerializer(serializers.ModelSerializer):
             validated_data['user'] = user.name
         return super().create(validated_data)
 
+class OrderLineProductField(serializers.PrimaryKeyRelatedField):
+    """Product of an order line, taken from the products OrderSerializer loaded for the whole order."""
+
+    def to_internal_value(self, data):
+        products = self.context.get('order_products', {})
+        if isinstance(data, (int, str)) and str(data).isdigit() and int(data) in products:
+            return products[int(data)]
+        return super().to_internal_value(data)
+
 class OrderItemSerializer(serializers.ModelSerializer):
     price = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)  # Read-only
+    product = OrderLineProductField(queryset=Product.objects.all(), allow_null=True, required=False)
     # product_name = serializers.CharField(source='product.name', read_only=True)
     product_price = serializers.CharField(source='product.selling_price', read_only=True)
 
@@ -109,21 +131,28 @@ class OrderItemSerializer(serializers.ModelSerializer):
         quantity_difference = new_quantity - instance.quantity
         # print(quantity_difference)
 
-        # Check stock availability based on the difference
-        if product.stock >= quantity_difference:
-            # print(product.stock)
-            product.stock -= quantity_difference  # Adjust stock by the difference
-            product.save()
-        else:
-            raise ValidationError(f"Insufficient stock for {product.name}. Available stock is {product.stock}, but {new_quantity} was requested.")
-        # print(product.stock)
-        # Update the instance's quantity
-        instance.quantity = new_quantity
-        instance.save()
+        with transaction.atomic():
+            if instance.order.status == 'Expired':
+                raise serializers.ValidationError({'quantity': ["The stock held for this order has expired. Place a new order."]})
+            # Adjust stock (or the order's hold) by the difference with a conditional update in the database
+            if product and quantity_difference:
+                stored = {product.pk: (instance.quantity, instance.cost or Decimal('0.00'))}
+                deltas = {product.pk: quantity_difference}
+                shortages, movements = apply_order_stock_deltas(instance.order, deltas, unit_costs=returned_unit_costs(stored, deltas))
+                if shortages:
+                    raise serializers.ValidationError({
+                        'quantity': [f"Insufficient stock for {product.name}. Available stock is {shortages[product.pk]}, but {new_quantity} was requested."]
+                    })
+                # Costed by the stock movement, so set_order_item_cost leaves it alone
+                instance.cost = order_line_costs(stored, deltas, movements)[product.pk]
+                instance._costed = True
+            # Update the instance's quantity
+            instance.quantity = new_quantity
+            instance.save()
 
         return instance
 
-class OrderGetSerializer(serializers.ModelSerializer):
+class OrderGetSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
     total_amount = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
     customer = serializers.CharField(source='customer.name', read_only=True)
@@ -151,130 +180,24 @@ class OrderSerializer(serializers.ModelSerializer):
             'total_amount': {'read_only': True}, # Make 'total_amount' read-only
         }
     
+    def to_internal_value(self, data):
+        # One query for the products of all lines instead of one per line; a batch
+        # of orders shares the context, so products already loaded are reused
+        products = self.context.setdefault('order_products', {})
+        missing = batch_product_ids([data]) - products.keys()
+        if missing:
+            products.update(Product.objects.in_bulk(missing))
+        return super().to_internal_value(data)
+
     def create(self, validated_data, user=None):
         user = self.context["request"].user
-        if user:
-            validated_data['user'] = user.name
-
-        items_data = validated_data.pop('items')
-        # Use a transaction to ensure atomicity
-        with transaction.atomic():
-            # Create the Order instance           
-            order = Order.objects.create(**validated_data)
-
-            # Create each OrderItem
-            for item_data in items_data:
-                # This will call OrderItemSerializer.validate() for each item
-                product = item_data['product']
-                quantity = item_data['quantity']
-                vat = 0.15
-                vat = Decimal(str(vat))
-
-                if item_data.get('product').receipt == True:
-                    # The total price with VAT
-                    total_price = item_data.get('product').selling_price * item_data['quantity'] + (item_data.get('product').selling_price * item_data['quantity'] *  vat)
-                else:
-                    # The total price without VAT
-                    total_price = item_data.get('product').selling_price * item_data['quantity']
-                
-                if quantity <= 0:
-                    raise ValidationError("Quantity must be greater than zero.")
-                
-
-                if product.stock >= quantity:  # Ensure there is enough stock
-                    product.stock -= quantity  # Reduce stock by the order quantity
-                    product.save()
-                else:
-                    raise ValidationError(f"Insufficient stock for {product.name}. Available stock is {product.stock}, but {quantity} was requested.")
-
-                # Create the OrderItem and associate with the Order
-                OrderItem.objects.create(order=order, price=total_price, **item_data)
-                # Adding it into the log with every itration
-                create_order_log(
-                    user = user.name,
-                    action="Create",
-                    model_name="Order",
-                    object_id=order.id,
-                    customer_info = order.customer,
-                    product_name = item_data['product'].name,
-                    quantity = item_data['quantity'],
-                    price = total_price,
-                    changes_on_update = "Created Order Item",
-                )
-                # Adding it into the report with every itration
-                if order.customer is None:
-                    create_order_report(
-                        user = user.name,
-                        customer_name = "Anonymous Customer",
-                        customer_phone = "0000000000",
-                        customer_tin_number = "1111",
-                        order_date = order.order_date,
-                        product_name = item_data['product'].name,
-                        product_price = item_data['product'].selling_price,
-                        quantity = item_data['quantity'],
-                        price = total_price
-                    )
-                else:
-                    create_order_report(
-                        user = user.name,
-                        customer_name = order.customer.name,
-                        customer_phone = order.customer.phone,
-                        customer_tin_number = order.customer.tin_number,
-                        order_date = order.order_date,
-                        product_name = item_data['product'].name,
-                        product_price = item_data['product'].selling_price,
-                        quantity = item_data['quantity'],
-                        price = total_price
-                    )
-            order.total_amount = order.get_total_price()
-            order.save()
-            return order
+        # Validates every line up front and bulk inserts items, logs and reports
+        return create_order(validated_data, user_name=user.name)
     
     
     def update(self, instance, validated_data):
-        # Update order fields directly
-        instance.customer = validated_data.get('customer', instance.customer)
-        instance.status = validated_data.get('status', instance.status)
-        instance.save()
-
-        # Update nested items
-        items_data = validated_data.pop('items', [])
-
-        # If there are new items in the request, update or create them
-        if items_data:
-            # Iterate through the provided items data
-            for item_data in items_data:
-                product = item_data['product']
-                new_quantity = item_data['quantity']
-
-                
-                if new_quantity <= 0:
-                    raise ValidationError("Quantity must be greater than zero.")
-
-                # Find the existing OrderItem or create a new one
-                order_item = instance.items.filter(product=product).first()
-
-                # Calculate the difference between new and existing quantity
-                quantity_difference = new_quantity - order_item.quantity
-
-                # Check stock availability based on the difference
-                if product.stock >= quantity_difference:
-                    product.stock -= quantity_difference  # Adjust stock by the difference
-                    product.save()
-
-                if order_item:
-                    # If the item exists, update the quantity
-                    order_item.quantity = new_quantity
-                    order_item.save()
-                else:
-                    # If the item doesn't exist, create a new one
-                    OrderItem.objects.create(order=instance, **item_data)
-                
-                
-
-                
-
-        return instance
+        # Diffs the lines against the order's items and writes the changes in bulk
+        return update_order(instance, validated_data, partial=self.partial)
 
 class OrderLogSerializer(serializers.ModelSerializer):
 
@@ -282,6 +205,13 @@ class OrderLogSerializer(serializers.ModelSerializer):
         model = OrderLog
         fields = '__all__'
 
+class StockMovementSerializer(serializers.ModelSerializer):
+    product_name = serializers.CharField(source='product.name', read_only=True)
+
+    class Meta:
+        model = StockMovement
+        fields = '__all__'
+
 class OrderReportSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -335,6 +265,8 @@ class PurchaseProductSerializer(serializers.ModelSerializer):
 
 class PurchaseExpenseSerializer(serializers.ModelSerializer):
     products = PurchaseProductSerializer(many=True)
+    # Move the buying price of received products to the weighted average cost
+    update_buying_price = serializers.BooleanField(default=False, write_only=True)
 
     class Meta:
         model = PurchaseExpense
@@ -346,12 +278,7 @@ class PurchaseExpenseSerializer(serializers.ModelSerializer):
             validated_data['user'] = user.name
         
         products_data = validated_data.pop('products', [])
-        
-        # Create and explicitly save the PurchaseExpense instance
-        purchase_expense = PurchaseExpense.objects.create(**validated_data)
-
-        # Create and associate PurchaseProduct instances individually
-        for product_data in products_data:
-            PurchaseProduct.objects.create(expense=purchase_expense, **product_data)
+        update_buying_price = validated_data.pop('update_buying_price', False)
 
-        return purchase_expense
+        # Computes the totals once, bulk inserts the lines and receives their stock
+        return create_purchase_expense(validated_data, products_data, update_buying_price)
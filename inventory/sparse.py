@@ -0,0 +1,144 @@
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+
+# Fields whose to_representation() works on the raw value of a column, so a
+# .values() row can be serialized without building a model instance
+VALUE_FIELDS = (
+    serializers.BooleanField,
+    serializers.CharField,
+    serializers.ChoiceField,
+    serializers.DateField,
+    serializers.DateTimeField,
+    serializers.DecimalField,
+    serializers.FloatField,
+    serializers.IntegerField,
+)
+
+
+def readable_fields(serializer):
+    """{name: field} of the fields a serializer outputs; write-only ones, like passwords, are never read back."""
+    return {name: field for name, field in serializer.fields.items() if not field.write_only}
+
+
+def sparse_fields(request):
+    """The field names asked for with ?fields=a,b,c, or None for all of them."""
+    value = request.query_params.get('fields')
+    if not value:
+        return None
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+class SparseFieldsMixin:
+    """
+    Serializer mixin taking a `fields` argument that limits the output to those fields.
+
+    Unknown names raise ValueError, so views can answer 400 instead of silently
+    returning less than the client asked for. Write-only fields count as unknown.
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            unknown = set(fields) - set(readable_fields(self))
+            if unknown:
+                raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}.")
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+def field_lookup(model, source):
+    """
+    ORM path for a dotted field source ('category.name' -> 'category__name'), or None
+    when part of it is not a concrete field (a property, a method or a reverse relation).
+    """
+    parts = source.split('.')
+    for position, part in enumerate(parts):
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete or field.many_to_many:
+            return None
+        if position < len(parts) - 1:
+            if not field.is_relation:
+                return None
+            model = field.related_model
+    return '__'.join(parts)
+
+
+def column_lookups(serializer):
+    """
+    ORM paths of the columns a serializer reads, or None when they cannot all be
+    worked out. Nested serializers are left to the view's prefetches.
+    """
+    model = serializer.Meta.model
+    lookups = {model._meta.pk.name}
+    for field in readable_fields(serializer).values():
+        if isinstance(field, serializers.BaseSerializer):
+            continue
+        if field.source == '*':
+            return None
+        lookup = field_lookup(model, field.source)
+        if lookup is None:
+            return None
+        lookups.add(lookup)
+    return lookups
+
+
+def limit_columns(queryset, serializer, extra=()):
+    """
+    Restrict `queryset` to the columns `serializer` renders plus `extra`.
+
+    Only the relations that a selected field reads are still joined. Prefetches are
+    kept only for the nested serializers that are still selected.
+    """
+    nested = {field.source for field in readable_fields(serializer).values() if isinstance(field, serializers.BaseSerializer)}
+    prefetches = [
+        lookup for lookup in queryset._prefetch_related_lookups
+        if getattr(lookup, 'prefetch_to', lookup).split('__')[0] in nested
+    ]
+    queryset = queryset.prefetch_related(None).prefetch_related(*prefetches)
+
+    lookups = column_lookups(serializer)
+    if lookups is None:
+        return queryset
+    lookups.update(extra)
+    related = {lookup.rsplit('__', 1)[0] for lookup in lookups if '__' in lookup}
+    return queryset.select_related(None).select_related(*related).only(*lookups)
+
+
+def is_value_field(field):
+    # Subclasses of ReadOnlyField may expect a model attribute, e.g. a FieldFile
+    return (
+        type(field) is serializers.ReadOnlyField
+        or isinstance(field, VALUE_FIELDS + (serializers.PrimaryKeyRelatedField,))
+    )
+
+
+def represent_value(field, value):
+    # .values() already holds the primary key of a relation
+    if value is None or isinstance(field, serializers.PrimaryKeyRelatedField):
+        return value
+    return field.to_representation(value)
+
+
+def serialize_rows(serializer_class, queryset, fields=None, context=None):
+    """
+    Serialize a list queryset, limited to `fields` when given.
+
+    When every selected field can be rendered from a plain column value, the rows
+    are read with .values() and no model instances are built at all. Otherwise the
+    queryset is narrowed to the columns the serializer reads before the usual
+    serialization.
+    """
+    serializer = serializer_class(fields=fields, context=context or {})
+    lookups = column_lookups(serializer)
+    readable = readable_fields(serializer)
+    if lookups is not None and all(is_value_field(field) for field in readable.values()):
+        columns = [
+            (name, field, field_lookup(serializer.Meta.model, field.source))
+            for name, field in readable.items()
+        ]
+        rows = queryset.values(*(lookup for name, field, lookup in columns))
+        return [{name: represent_value(field, row[lookup]) for name, field, lookup in columns} for row in rows]
+    return serializer_class(limit_columns(queryset, serializer), many=True, fields=fields, context=context or {}).data
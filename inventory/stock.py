@@ -0,0 +1,165 @@
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, FloatField, IntegerField, Value, When
+from django.db.models.functions import Cast
+from .models import Product, StockMovement, post_stock_costs, record_product_changes
+
+
+def available_stock(product_ids):
+    """{product_id: stock that can still be sold} for the given products."""
+    return {
+        product_id: max(stock - reserved, 0)
+        for product_id, stock, reserved in Product.objects.filter(pk__in=product_ids).values_list('id', 'stock', 'reserved')
+    }
+
+
+def per_product(quantities, output_field=None):
+    """A CASE expression giving each product's value from {product_id: value}."""
+    return Case(
+        *[When(pk=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+        default=Value(0),
+        output_field=output_field or IntegerField(),
+    )
+
+
+def shift_products(deltas, field):
+    """
+    Move `field` ('stock' or 'reserved') by {product_id: quantity} in at most two
+    statements, only taking from products with enough available stock.
+
+    Quantities taken out of availability go through one conditional UPDATE. If it
+    misses any product, it is rolled back to its savepoint and the shortages are
+    returned as {product_id: available_stock}, with nothing changed. Otherwise a
+    second UPDATE applies the quantities given back. Both are written as
+    subtractions or additions of positive numbers, which MySQL accepts on unsigned
+    columns. Multi-row UPDATEs lock rows in primary key order, so concurrent
+    callers cannot deadlock on each other.
+    """
+    taken = {product_id: quantity for product_id, quantity in deltas.items() if quantity > 0}
+    returned = {product_id: -quantity for product_id, quantity in deltas.items() if quantity < 0}
+    # Taking stock lowers `stock` but raises `reserved`; giving it back does the opposite
+    if field == 'stock':
+        take, give = F('stock') - per_product(taken), F('stock') + per_product(returned)
+    else:
+        take, give = F('reserved') + per_product(taken), F('reserved') - per_product(returned)
+
+    if taken:
+        with transaction.atomic():
+            updated = Product.objects.filter(pk__in=taken, stock__gte=F('reserved') + per_product(taken)).update(**{field: take})
+            if updated != len(taken):
+                transaction.set_rollback(True)
+        if updated != len(taken):
+            available = available_stock(taken)
+            return {
+                product_id: available.get(product_id, 0) for product_id, quantity in taken.items()
+                if available.get(product_id, 0) < quantity
+            } or available
+    if returned:
+        Product.objects.filter(pk__in=returned).update(**{field: give})
+
+    # Queryset updates send no signals, so journal the change and bump the list version here
+    record_product_changes(list(taken) + list(returned))
+    return {}
+
+
+def apply_stock_deltas(deltas):
+    """
+    Take stock out of (or put it back into) several products at once.
+
+    `deltas` maps product ids to the quantity to take out; negative quantities put
+    stock back. The availability check is part of the UPDATE and evaluated by the
+    database, so two sales of the same product can never both pass a stale check.
+    Units reserved for Pending orders cannot be sold.
+
+    Returns {product_id: available_stock} for the products that could not cover
+    their quantity, in which case no stock was changed. The caller must run inside
+    transaction.atomic() and roll back when anything is returned.
+    """
+    return shift_products(deltas, 'stock')
+
+
+def apply_reservation_deltas(deltas):
+    """
+    Hold (or release) stock for Pending orders without taking it out of stock.
+
+    Works like apply_stock_deltas on the products' `reserved` counter: positive
+    quantities are held only if that much is still available, negative ones are
+    released. Returns {product_id: available_stock} for the products that could
+    not cover their quantity; the caller must then roll back.
+    """
+    return shift_products(deltas, 'reserved')
+
+
+def consume_reserved_stock(held):
+    """
+    Turn held units into sold ones: take {product_id: quantity} out of both stock
+    and the reserved counter in one UPDATE. Returns False, with nothing changed,
+    when a product's stock was lowered below its holds by hand in the meantime.
+    """
+    quantities = per_product(held)
+    with transaction.atomic():
+        updated = Product.objects.filter(pk__in=held, stock__gte=quantities, reserved__gte=quantities).update(
+            stock=F('stock') - quantities,
+            reserved=F('reserved') - quantities,
+        )
+        if updated != len(held):
+            transaction.set_rollback(True)
+            return False
+    record_product_changes(held)
+    return True
+
+
+def receive_stock(received, weighted_cost=False):
+    """
+    Add delivered stock to several products with one UPDATE.
+
+    `received` maps product ids to (quantity, cost), the cost being what the
+    invoice charged for those units. With `weighted_cost` the buying price becomes
+    the weighted average of the stock on hand at its old price and the delivery
+    at its invoice price, in the same statement.
+    """
+    quantities = {product_id: quantity for product_id, (quantity, cost) in received.items() if quantity > 0}
+    if not quantities:
+        return
+    changes = {}
+    if weighted_cost:
+        price = DecimalField(max_digits=20, decimal_places=2)
+        cost = per_product({product_id: received[product_id][1] for product_id in quantities}, price)
+        delivery_price = per_product({product_id: received[product_id][1] / quantities[product_id] for product_id in quantities}, price)
+        changes['buying_price'] = Case(
+            When(buying_price__isnull=True, then=delivery_price),
+            # SQLite stores whole decimals as integers, so divide by a float to keep the fraction
+            default=(F('stock') * F('buying_price') + cost) / Cast(F('stock') + per_product(quantities), FloatField()),
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        )
+    # Listed after buying_price: MySQL evaluates SET assignments left to right, so
+    # the average above still sees the stock from before the delivery
+    changes['stock'] = F('stock') + per_product(quantities)
+    Product.objects.filter(pk__in=quantities).update(**changes)
+    record_product_changes(quantities)
+
+
+def record_stock_movements(changes, reason, source_model=None, source_id=None, user=None, unit_costs=None):
+    """
+    Append one ledger row per product to StockMovement from {product_id: change}.
+
+    Set-based stock updates send no signals, so every caller that moves stock with
+    one records what it did here, with the same sign as the change to Product.stock.
+    The movements are costed on the way in (see post_stock_costs); `unit_costs`
+    gives incoming units a known cost. Returns {product_id: movement}.
+    """
+    unit_costs = unit_costs or {}
+    movements = [
+        StockMovement(
+            product_id=product_id,
+            quantity=quantity,
+            reason=reason,
+            source_model=source_model,
+            source_id=source_id,
+            unit_cost=unit_costs.get(product_id) if quantity > 0 else None,
+            user=user,
+        )
+        for product_id, quantity in changes.items() if quantity
+    ]
+    post_stock_costs(movements)
+    StockMovement.objects.bulk_create(movements)
+    return {movement.product_id: movement for movement in movements}
@@ -1,3 +1,521 @@
-from django.test import TestCase
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+from user.models import UserAccount
+from user.serializers import UserSerializer
+from .costing import recompute_costs
+from .idempotency import idempotent
+from .models import Category, ChangeJournal, CostLayer, CustomerInfo, DailySalesRollup, IdempotencyKey, Order, OrderItem, OrderLog, Product, Report, StockMovement, StockReservation, record_changes
+from .orders import create_order, update_order
+from .purchases import create_purchase_expense
+from .reservations import release_expired_reservations
+from .sparse import serialize_rows
+from .sync import build_change_feed
+from .utils import create_order_log, create_order_report
+from .views import OrderBatchAPIView, OrderListCreateAPIView
 
-# Create your tests here.
+
+class ConcurrentStockDecrementTest(TransactionTestCase):
+    """Many salesmen selling the same product at once must never oversell it."""
+
+    initial_stock = 50
+    threads = 10
+    sales_per_thread = 8
+
+    def setUp(self):
+        category = Category.objects.create(name='Cement')
+        self.product = Product.objects.create(name='Cement 50kg', category=category, selling_price='10.00', buying_price='8.00', stock=self.initial_stock)
+
+    def sell(self, results):
+        try:
+            for _ in range(self.sales_per_thread):
+                product = Product.objects.get(pk=self.product.pk)
+                try:
+                    create_order({'status': 'Completed', 'items': [{'product': product, 'quantity': 1}]}, user_name='Salesman')
+                    results.append(True)
+                except serializers.ValidationError:
+                    results.append(False)
+        finally:
+            connection.close()
+
+    def test_final_stock_is_exact(self):
+        results = []
+        workers = [threading.Thread(target=self.sell, args=(results,)) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        sold = results.count(True)
+        self.product.refresh_from_db()
+        self.assertEqual(len(results), self.threads * self.sales_per_thread)
+        self.assertEqual(sold, self.initial_stock)
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(OrderItem.objects.filter(product=self.product).count(), sold)
+        self.assertEqual(Order.objects.count(), sold)
+
+    def test_shortage_is_reported_per_line(self):
+        other = Product.objects.create(name='Rebar 12mm', selling_price='5.00', stock=2)
+        items = [
+            {'product': self.product, 'quantity': 1},
+            {'product': other, 'quantity': 3},
+        ]
+        with self.assertRaises(serializers.ValidationError) as raised:
+            create_order({'status': 'Completed', 'items': items}, user_name='Salesman')
+
+        errors = raised.exception.detail['items']
+        self.assertEqual(errors[0], {})
+        self.assertIn('Insufficient stock for Rebar 12mm', str(errors[1]['quantity'][0]))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, self.initial_stock)
+
+    def test_edit_shortage_reports_the_wanted_quantity(self):
+        product = Product.objects.get(pk=self.product.pk)
+        order = create_order({'status': 'Completed', 'items': [{'product': product, 'quantity': 45}]}, user_name='Salesman')
+        with self.assertRaises(serializers.ValidationError) as raised:
+            update_order(order, {'items': [{'product': product, 'quantity': 60}]})
+
+        message = str(raised.exception.detail['items'][0]['quantity'][0])
+        self.assertIn('but 60 was requested', message)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, self.initial_stock - 45)
+
+
+def create_order_per_item(validated_data, user_name):
+    """The per-item order write that create_order replaced, kept to compare results against."""
+    items_data = validated_data.pop('items')
+    order = Order.objects.create(user=user_name, **validated_data)
+    for item_data in items_data:
+        product = item_data['product']
+        quantity = item_data['quantity']
+        if product.receipt:
+            total_price = product.selling_price * quantity + product.selling_price * quantity * Decimal('0.15')
+        else:
+            total_price = product.selling_price * quantity
+        product.stock -= quantity
+        product.save()
+        OrderItem.objects.create(order=order, price=total_price, **item_data)
+        create_order_log(
+            user=user_name,
+            action="Create",
+            model_name="Order",
+            object_id=order.id,
+            customer_info=order.customer,
+            product_name=product.name,
+            quantity=quantity,
+            price=total_price,
+            changes_on_update="Created Order Item",
+        )
+        customer = order.customer
+        create_order_report(
+            user=user_name,
+            customer_name=customer.name if customer else "Anonymous Customer",
+            customer_phone=customer.phone if customer else "0000000000",
+            customer_tin_number=customer.tin_number if customer else "1111",
+            order_date=order.order_date,
+            product_name=product.name,
+            product_price=product.selling_price,
+            quantity=quantity,
+            price=total_price,
+        )
+    order.total_amount = order.get_total_price()
+    order.save()
+    return order
+
+
+class BulkOrderWriteTest(TestCase):
+    """create_order must write the same order, lines, log and report rows as the per-item path did."""
+
+    def setUp(self):
+        category = Category.objects.create(name='Cement')
+        Product.objects.create(name='Cement 50kg', category=category, selling_price='7.35', buying_price='6.00', stock=100, receipt=True)
+        Product.objects.create(name='Rebar 12mm', category=category, selling_price='3.10', buying_price='2.00', stock=100)
+        self.customer = CustomerInfo.objects.create(name='Abebe', phone='0911000000', tin_number='22')
+
+    def written(self, order):
+        items = OrderItem.objects.filter(order=order).order_by('id').values_list('product', 'quantity', 'price', 'receipt')
+        logs = OrderLog.objects.filter(object_id=order.id).order_by('id').values_list(
+            'user', 'action', 'model_name', 'customer_info', 'product_name', 'quantity', 'price', 'changes_on_update'
+        )
+        reports = Report.objects.filter(order_date=order.order_date).order_by('id').values_list(
+            'user', 'customer_name', 'customer_phone', 'customer_tin_number', 'product_name', 'product_price', 'quantity', 'price'
+        )
+        order.refresh_from_db()
+        return (order.customer_id, order.status, order.total_amount, order.user), list(items), list(logs), list(reports)
+
+    def test_same_rows_as_per_item_path(self):
+        for customer in (self.customer, None):
+            def order_data():
+                cement, rebar = Product.objects.get(name='Cement 50kg'), Product.objects.get(name='Rebar 12mm')
+                return {
+                    'customer': customer,
+                    'status': 'Completed',
+                    'items': [
+                        {'product': cement, 'quantity': 3},
+                        {'product': rebar, 'quantity': 4, 'receipt': True},
+                        {'product': rebar, 'quantity': 1},
+                    ],
+                }
+
+            stock_before = dict(Product.objects.values_list('name', 'stock'))
+            expected = self.written(create_order_per_item(order_data(), 'Salesman'))
+            stock_after_per_item = dict(Product.objects.values_list('name', 'stock'))
+            actual = self.written(create_order(order_data(), user_name='Salesman'))
+
+            self.assertEqual(actual, expected)
+            self.assertEqual(actual[0][2], Decimal('40.86'))
+            stock_after = dict(Product.objects.values_list('name', 'stock'))
+            for name, stock in stock_before.items():
+                self.assertEqual(stock_after_per_item[name] - stock_after[name], stock - stock_after_per_item[name])
+
+
+class ChangeFeedTest(TransactionTestCase):
+    """A change committed after one with a later token must still reach the client."""
+
+    def setUp(self):
+        self.slow = Product.objects.create(name='Cement 50kg', selling_price='10.00', stock=5)
+        self.quick = Product.objects.create(name='Rebar 12mm', selling_price='5.00', stock=5)
+
+    def synced_products(self, feed):
+        return {row['id'] for rows in (feed['products']['created'], feed['products']['updated']) for row in rows}
+
+    def long_batch(self, journaled, release):
+        try:
+            with transaction.atomic():
+                record_changes('product', [self.slow.pk])
+                journaled.set()
+                # Commits after the other change, unless the database lets one writer at a time in
+                release.wait(timeout=1)
+        finally:
+            connection.close()
+
+    @override_settings(SYNC_SETTLE_SECONDS=0)
+    def test_change_committed_out_of_order_is_synced(self):
+        first = build_change_feed()
+        journaled, release = threading.Event(), threading.Event()
+        batch = threading.Thread(target=self.long_batch, args=(journaled, release))
+        batch.start()
+        journaled.wait()
+        record_changes('product', [self.quick.pk])
+        second = build_change_feed(since=first['next_token'])
+        release.set()
+        batch.join()
+        third = build_change_feed(since=second['next_token'])
+
+        synced = self.synced_products(second) | self.synced_products(third)
+        self.assertEqual(synced, {self.slow.pk, self.quick.pk})
+
+    def test_rolled_back_change_is_not_journaled(self):
+        journaled = ChangeJournal.objects.count()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                record_changes('product', [self.slow.pk])
+                self.assertEqual(ChangeJournal.objects.count(), journaled)
+                raise RuntimeError
+        self.assertEqual(ChangeJournal.objects.count(), journaled)
+
+
+class HeldOrderView(APIView):
+    """Places an order, then keeps its transaction open until the test lets it finish."""
+    placed = None
+    release = None
+    fail = False
+
+    @idempotent('orders')
+    def post(self, request, format=None):
+        product = Product.objects.get(pk=request.data['product'])
+        create_order({'status': 'Completed', 'items': [{'product': product, 'quantity': 1}]}, user_name=request.user.name)
+        if self.fail:
+            raise RuntimeError("Lost the connection to the printer.")
+        if self.placed:
+            self.placed.set()
+            self.release.wait(timeout=1)
+        return Response({"message": "Order Created successfully."}, status=201)
+
+
+class IdempotencyKeyTest(TransactionTestCase):
+    """A retried POST with the same Idempotency-Key must never place the order twice."""
+
+    def setUp(self):
+        self.user = UserAccount.objects.create_stuff('salesman@example.com', 'Salesman', 'secret-password', 'Manager')
+        self.product = Product.objects.create(name='Cement 50kg', selling_price='10.00', stock=20)
+        self.body = {'status': 'Completed', 'items': [{'product': self.product.pk, 'quantity': 2}]}
+
+    def post(self, body, key, view=OrderListCreateAPIView):
+        request = APIRequestFactory().post('/api/inventory/orders', body, format='json', HTTP_IDEMPOTENCY_KEY=key)
+        force_authenticate(request, user=self.user)
+        return view.as_view()(request)
+
+    def stock(self):
+        return Product.objects.get(pk=self.product.pk).stock
+
+    def test_retry_gets_the_stored_response(self):
+        first = self.post(self.body, 'till-1-0001')
+        retry = self.post(self.body, 'till-1-0001')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual((retry.status_code, retry.data), (201, first.data))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.stock(), 18)
+
+    def test_key_reused_for_another_body_is_refused(self):
+        self.post(self.body, 'till-1-0001')
+        other = {'status': 'Completed', 'items': [{'product': self.product.pk, 'quantity': 5}]}
+
+        self.assertEqual(self.post(other, 'till-1-0001').status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.stock(), 18)
+
+    def send_held(self, results):
+        try:
+            results.append(self.post({'product': self.product.pk}, 'till-1-0002', HeldOrderView))
+        finally:
+            connection.close()
+
+    def test_retry_while_first_request_runs_is_not_run(self):
+        HeldOrderView.placed, HeldOrderView.release = threading.Event(), threading.Event()
+        self.addCleanup(setattr, HeldOrderView, 'placed', None)
+        results = []
+        first = threading.Thread(target=self.send_held, args=(results,))
+        first.start()
+        HeldOrderView.placed.wait()
+        # However long the first request has been running, its claim is not taken over
+        later = timezone.now() + timedelta(minutes=10)
+        with mock.patch('inventory.idempotency.timezone.now', return_value=later):
+            retry = self.post({'product': self.product.pk}, 'till-1-0002', HeldOrderView)
+        HeldOrderView.release.set()
+        first.join()
+
+        if connection.vendor == 'mysql':
+            # The running request keeps its claim locked, so the lookup fails at once
+            self.assertEqual(retry.status_code, 409)
+        elif retry.status_code != 409:
+            # SQLite lets one writer in at a time: the retry waited and got the stored response
+            self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(results[0].status_code, 201)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.stock(), 19)
+
+    def test_expired_key_is_taken_over(self):
+        self.post(self.body, 'till-1-0001')
+        IdempotencyKey.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.post(self.body, 'till-1-0001').status_code, 201)
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 201)
+
+    def test_failed_request_leaves_the_key_free(self):
+        HeldOrderView.fail = True
+        self.addCleanup(setattr, HeldOrderView, 'fail', False)
+        with self.assertRaises(RuntimeError):
+            self.post({'product': self.product.pk}, 'till-1-0003', HeldOrderView)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.stock(), 20)
+
+        HeldOrderView.fail = False
+        self.assertEqual(self.post({'product': self.product.pk}, 'till-1-0003', HeldOrderView).status_code, 201)
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class OrderBatchTest(TransactionTestCase):
+    """A batch keeps the orders that succeed, or none of them with all_or_nothing."""
+
+    def setUp(self):
+        self.user = UserAccount.objects.create_stuff('salesman@example.com', 'Salesman', 'secret-password', 'Salesman')
+        self.cement = Product.objects.create(name='Cement 50kg', selling_price='10.00', stock=10)
+        self.rebar = Product.objects.create(name='Rebar 12mm', selling_price='5.00', stock=3)
+        self.orders = [
+            {'status': 'Completed', 'items': [{'product': self.cement.pk, 'quantity': 4}]},
+            {'status': 'Completed', 'items': [{'product': self.rebar.pk, 'quantity': 5}]},
+            {'status': 'Completed', 'items': [{'product': self.cement.pk, 'quantity': 1}, {'product': self.rebar.pk, 'quantity': 2}]},
+        ]
+
+    def post(self, body):
+        request = APIRequestFactory().post('/api/inventory/orders/batch/', body, format='json')
+        force_authenticate(request, user=self.user)
+        return OrderBatchAPIView.as_view()(request)
+
+    def stock(self):
+        return dict(Product.objects.values_list('name', 'stock'))
+
+    def test_failed_order_leaves_the_others_in(self):
+        response = self.post({'orders': self.orders})
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 1))
+        self.assertEqual([result['status'] for result in response.data['results']], ['created', 'error', 'created'])
+        self.assertIn('items', response.data['results'][1]['errors'])
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(self.stock(), {'Cement 50kg': 5, 'Rebar 12mm': 1})
+        self.assertEqual(StockMovement.objects.filter(reason='sale').count(), 3)
+
+    def test_all_or_nothing_rolls_back_every_order(self):
+        stock = self.stock()
+        movements = StockMovement.objects.count()
+        response = self.post({'orders': self.orders, 'all_or_nothing': True})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((response.data['created'], response.data['failed']), (0, 1))
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], ['rolled_back', 'error', 'rolled_back'])
+        self.assertEqual([results[0]['id'], results[2]['id']], [None, None])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stock(), stock)
+        self.assertEqual(StockMovement.objects.count(), movements)
+
+
+class StockReservationTest(TestCase):
+    """A Pending order holds its stock until it is completed or its hold expires."""
+
+    def setUp(self):
+        Product.objects.create(name='Cement 50kg', selling_price='10.00', buying_price='8.00', stock=10)
+        self.product = Product.objects.get(name='Cement 50kg')
+        self.order = create_order({'status': 'Pending', 'items': [{'product': self.product, 'quantity': 4}]}, user_name='Salesman')
+
+    def assertStock(self, stock, reserved):
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved), (stock, reserved))
+
+    def test_pending_order_holds_stock(self):
+        self.assertStock(10, 4)
+        self.assertEqual(list(self.order.reservations.values_list('product_id', 'quantity')), [(self.product.pk, 4)])
+        self.assertFalse(StockMovement.objects.filter(reason='sale').exists())
+
+    def test_completing_sells_what_is_held(self):
+        update_order(self.order, {'status': 'Completed'})
+
+        self.assertStock(6, 0)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(list(StockMovement.objects.filter(reason='sale').values_list('source_id', 'quantity')), [(self.order.pk, -4)])
+
+    def test_editing_resizes_the_hold(self):
+        update_order(self.order, {'items': [{'product': self.product, 'quantity': 7}]})
+        self.assertStock(10, 7)
+        update_order(self.order, {'items': [{'product': self.product, 'quantity': 2}]})
+        self.assertStock(10, 2)
+        self.assertEqual(self.order.reservations.get().quantity, 2)
+
+    def test_expired_hold_is_released(self):
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(release_expired_reservations(), 1)
+        self.assertStock(10, 0)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, 'Expired')
+
+    def test_expired_order_cannot_be_completed(self):
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        release_expired_reservations()
+
+        # Whether the order was read before the sweep or after it
+        for order in (self.order, Order.objects.get(pk=self.order.pk)):
+            with self.assertRaises(serializers.ValidationError):
+                update_order(order, {'status': 'Completed'})
+        self.assertStock(10, 0)
+        self.assertFalse(StockMovement.objects.filter(reason='sale').exists())
+
+
+class CostOfSalesTest(TestCase):
+    """Sales are costed from the purchase layers they use up, oldest first."""
+
+    def setUp(self):
+        Product.objects.create(name='Rebar 12mm', selling_price='12.00', buying_price='6.00', stock=0)
+
+    def product(self):
+        return Product.objects.get(name='Rebar 12mm')
+
+    def buy(self, quantity, unit_price):
+        line = {'stock_product': self.product(), 'product': 'Rebar 12mm', 'quantity': quantity, 'unit_price': Decimal(unit_price)}
+        create_purchase_expense({'payment_status': 'Paid', 'user': 'Manager'}, [line])
+
+    def sell(self, quantity):
+        return create_order({'status': 'Completed', 'items': [{'product': self.product(), 'quantity': quantity}]}, user_name='Salesman')
+
+    def line_cost(self, order):
+        return order.items.get().cost
+
+    def layers(self):
+        return list(CostLayer.objects.order_by('received_at', 'id').values_list('remaining', 'unit_cost'))
+
+    def test_sale_uses_up_the_oldest_layers_first(self):
+        self.buy(10, '8.00')
+        self.buy(10, '9.00')
+        self.assertEqual(self.product().average_cost, Decimal('8.500000'))
+
+        self.assertEqual(self.line_cost(self.sell(15)), Decimal('125.00'))
+        self.assertEqual(self.layers(), [(5, Decimal('9.000000'))])
+        self.assertEqual(self.line_cost(self.sell(3)), Decimal('27.00'))
+
+    def test_units_taken_off_an_order_return_at_their_cost(self):
+        self.buy(10, '8.00')
+        order = self.sell(6)
+        self.buy(10, '9.00')
+
+        update_order(order, {'items': [{'product': self.product(), 'quantity': 4}]})
+        self.assertEqual(self.line_cost(order), Decimal('32.00'))
+        returned = StockMovement.objects.get(reason='edit')
+        self.assertEqual((returned.quantity, returned.unit_cost), (2, Decimal('8.000000')))
+        self.assertEqual(self.layers(), [(4, Decimal('8.000000')), (10, Decimal('9.000000')), (2, Decimal('8.000000'))])
+
+    def test_stock_counted_short_leaves_from_the_oldest_layers(self):
+        self.buy(10, '8.00')
+        self.buy(10, '9.00')
+        product = self.product()
+        product.stock = 15
+        product.save()
+
+        shrinkage = StockMovement.objects.get(reason='stocktake')
+        self.assertEqual((shrinkage.quantity, shrinkage.unit_cost), (-5, Decimal('8.000000')))
+        self.assertEqual(self.layers(), [(5, Decimal('8.000000')), (10, Decimal('9.000000'))])
+        self.assertEqual(self.line_cost(self.sell(8)), Decimal('67.00'))
+
+    def test_recompute_matches_the_live_costs(self):
+        self.buy(10, '8.00')
+        first = self.sell(6)
+        self.buy(10, '9.00')
+        update_order(first, {'items': [{'product': self.product(), 'quantity': 4}]})
+        product = self.product()
+        product.stock = 15
+        product.save()
+        self.sell(12)
+        self.buy(5, '10.00')
+        self.sell(4)
+
+        costs = dict(OrderItem.objects.values_list('id', 'cost'))
+        movements = dict(StockMovement.objects.values_list('id', 'unit_cost'))
+        layers, average = self.layers(), self.product().average_cost
+        rollup = sorted(DailySalesRollup.objects.values_list('date', 'product_id', 'user', 'cost'))
+
+        OrderItem.objects.update(cost=Decimal('0.00'))
+        today = timezone.localdate()
+        recompute_costs(today, today)
+
+        self.assertEqual(dict(OrderItem.objects.values_list('id', 'cost')), costs)
+        self.assertEqual(dict(StockMovement.objects.values_list('id', 'unit_cost')), movements)
+        self.assertEqual((self.layers(), self.product().average_cost), (layers, average))
+        self.assertEqual(sorted(DailySalesRollup.objects.values_list('date', 'product_id', 'user', 'cost')), rollup)
+
+
+class SparseFieldsTest(TestCase):
+    """?fields= must never reach write-only fields such as the password hash."""
+
+    def setUp(self):
+        UserAccount.objects.create_user(email='salesman@example.com', name='Salesman', password='secret-password')
+
+    def test_write_only_field_cannot_be_selected(self):
+        with self.assertRaises(ValueError):
+            serialize_rows(UserSerializer, UserAccount.objects.all(), ['id', 'name', 'password'])
+
+    def test_rows_leave_out_write_only_fields(self):
+        for fields in (None, ['id', 'name']):
+            rows = serialize_rows(UserSerializer, UserAccount.objects.all(), fields)
+            self.assertEqual(len(rows), 1)
+            self.assertNotIn('password', rows[0])
@@ -7,6 +7,7 @@ from .views import (
     SupplierRetrieveUpdateDeleteAPIView,
 
     OrderListCreateAPIView,
+    OrderBatchAPIView,
     OrderRetrieveUpdateDeleteAPIView,
 
     OrderItemListCreateAPIView,
@@ -18,10 +19,19 @@ from .views import (
     CategoryListCreateAPIView,
     CategoryRetrieveUpdateDeleteAPIView,
 
+    ReferenceCacheStatsAPIView,
+    SyncAPIView,
+    AuditOutboxAPIView,
+    ProductImportAPIView,
+    ProductBulkAdjustAPIView,
+
     RetriveRevenueAPIView,
     RetriveProfitAPIView,
     ExcelReportAPIView,
+    ReportExportAPIView,
     OrderLogAPIView,
+    StockMovementListAPIView,
+    StockAtAPIView,
 
     CompanyListCreateAPIView,
     CompanyRetrieveUpdateDeleteAPIView,
@@ -47,12 +57,15 @@ from .views import (
 
 urlpatterns = [
     path('products', ProductListCreateAPIView.as_view(), name='products-list'),
+    path('products_import/', ProductImportAPIView.as_view(), name='products-import'),
+    path('products_adjust/', ProductBulkAdjustAPIView.as_view(), name='products-adjust'),
     path('products/<pk>', ProductRetrieveUpdateDeleteAPIView.as_view(), name='products-retrieve'),
 
     path('suppliers', SupplierListCreateAPIView.as_view(), name='suppliers-list'),
     path('suppliers/<pk>', SupplierRetrieveUpdateDeleteAPIView.as_view(), name='suppliers-retrieve'),
 
     path('orders', OrderListCreateAPIView.as_view(), name='orders-list'),
+    path('orders_batch/', OrderBatchAPIView.as_view(), name='orders-batch'),
     path('orders/<pk>', OrderRetrieveUpdateDeleteAPIView.as_view(), name='orders-retrieve'),
 
     path('orderitems', OrderItemListCreateAPIView.as_view(), name='orders-items-list'),
@@ -67,12 +80,19 @@ urlpatterns = [
     path('category', CategoryListCreateAPIView.as_view(), name='category-list'),
     path('category/<pk>', CategoryRetrieveUpdateDeleteAPIView.as_view(), name='category-retrieve'),
 
+    path('sync', SyncAPIView.as_view(), name='sync'),
+    path('audit_outbox/', AuditOutboxAPIView.as_view(), name='audit-outbox-lag'),
+    path('cache_stats/', ReferenceCacheStatsAPIView.as_view(), name='reference-cache-stats'),
+
     path('revenue/', RetriveRevenueAPIView.as_view(), name='revenue-retrieve'),
     path('profit/', RetriveProfitAPIView.as_view(), name='profit-retrieve'),
     path('report/', ExcelReportAPIView.as_view(), name='report-retrieve'),
+    path('report/export/', ReportExportAPIView.as_view(), name='report-export'),
     path('order_log/', OrderLogAPIView.as_view(), name='order-log-retrieve'),
     path('stock/', ListOutOFStockProductAPIView.as_view(), name='stock-shortage-retrieve'),
     path('stock_count/', CountNearExpirationDateProductAPIView.as_view(), name='stock-shortage-count-retrieve'),
+    path('stock_movements/', StockMovementListAPIView.as_view(), name='stock-movement-list'),
+    path('stock_at/', StockAtAPIView.as_view(), name='stock-at-retrieve'),
 
     path('expense_type', ExpenseTypesListCreateAPIView.as_view(), name='expense_type-list'),
     path('expense_type/<pk>', ExpenseTypesRetrieveUpdateDeleteAPIView.as_view(), name='expense_type-retrieve'),
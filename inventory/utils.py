@@ -1,4 +1,23 @@
-from .models import OrderLog, Report
+from .models import OrderLog, Report, CollectionVersion
+from .audit import outbox_enabled, enqueue
+from rest_framework import status
+from rest_framework.response import Response
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from functools import wraps
+import hashlib
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from datetime import date, datetime, time, timedelta
+import base64
+import json
+from django.conf import settings
+from django.core.cache import cache
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
 
 def create_log(user, action, model_name, object_id, details=None):
     Log.objects.create(
@@ -12,6 +31,19 @@ def create_log(user, action, model_name, object_id, details=None):
 
 def create_order_log(user, action, model_name, object_id, customer_info, product_name, quantity, price, changes_on_update):
     # print("Order Log Active")
+    if outbox_enabled():
+        enqueue('order_log', {
+            'user': user,
+            'action': action,
+            'model_name': model_name,
+            'object_id': object_id,
+            'customer_info': str(customer_info) if customer_info is not None else None,
+            'product_name': product_name,
+            'quantity': quantity,
+            'price': price,
+            'changes_on_update': changes_on_update,
+        })
+        return
     OrderLog.objects.create(
         user=user,
         action=action,
@@ -27,6 +59,19 @@ def create_order_log(user, action, model_name, object_id, customer_info, product
 
 def create_order_report(user, customer_name, customer_phone, customer_tin_number, order_date, product_name, product_price, quantity, price):
     # print("Order Report Active")
+    if outbox_enabled():
+        enqueue('order_report', {
+            'user': user,
+            'customer_name': customer_name,
+            'customer_phone': customer_phone,
+            'customer_tin_number': customer_tin_number,
+            'order_date': order_date,
+            'product_name': product_name,
+            'product_price': product_price,
+            'quantity': quantity,
+            'price': price,
+        })
+        return
     Report.objects.create(
         user = user,
         customer_name = customer_name,
@@ -39,3 +84,185 @@ def create_order_report(user, customer_name, customer_phone, customer_tin_number
         price = price
     )
 
+
+def wants_pagination(request):
+    """A list endpoint switches to cursor (keyset) pagination when the client asks for a page."""
+    return 'cursor' in request.query_params or 'page_size' in request.query_params
+
+
+def get_page_size(request, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    try:
+        page_size = int(request.query_params.get('page_size', default))
+    except (TypeError, ValueError):
+        raise ValueError("page_size must be an integer.")
+    return max(1, min(page_size, maximum))
+
+
+def cursor_value(value):
+    # Full precision: DjangoJSONEncoder would cut datetimes to milliseconds and skip rows
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, default=cursor_value).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(token):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(values, list) or not values:
+        raise ValueError("Invalid cursor.")
+    return values
+
+
+def keyset_paginate(queryset, ordering='id', cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Return one page of `queryset` and the cursor for the next page.
+
+    Rows are ordered by `ordering` (e.g. 'name' or '-id') with the primary key as
+    tie breaker, and the next page starts strictly after the last row seen, so the
+    database seeks through an index instead of counting an OFFSET.
+    """
+    descending = ordering.startswith('-')
+    field = ordering.lstrip('-')
+    keys = ['id'] if field == 'id' else [field, 'id']
+    queryset = queryset.order_by(*[f"-{key}" if descending else key for key in keys])
+
+    if cursor:
+        position = decode_cursor(cursor)
+        if position[0] != ordering or len(position) != len(keys) + 1:
+            raise ValueError("Cursor does not match the requested ordering.")
+        lookup = 'lt' if descending else 'gt'
+        if len(keys) == 1:
+            queryset = queryset.filter(**{f'id__{lookup}': position[1]})
+        else:
+            value, pk = position[1], position[2]
+            queryset = queryset.filter(
+                Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': pk})
+            )
+
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor([ordering] + [getattr(last, key) for key in keys])
+    return rows, next_cursor
+
+
+def iterate_in_chunks(queryset, chunk_size=2000):
+    """
+    Yield the rows of `queryset` in primary key order, fetching `chunk_size` rows per query.
+
+    Each chunk starts after the last id of the previous one, so memory stays flat even
+    on MySQL, whose driver buffers a whole result set instead of streaming it.
+    Rows may be model instances, values() dicts, or values_list() tuples that start
+    with the id.
+    """
+    last_id = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_id is not None:
+            chunk = chunk.filter(pk__gt=last_id)
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            return
+        yield from rows
+        last = rows[-1]
+        if isinstance(last, dict):
+            last_id = last['id']
+        elif isinstance(last, tuple):
+            last_id = last[0]
+        else:
+            last_id = last.pk
+
+
+def parse_date_param(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_date(value)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValueError(f"'{name}' must be a date in YYYY-MM-DD format.")
+    return parsed
+
+
+def date_range_lookups(params, field):
+    """
+    Turn the `from` / `to` dates of a request into lookups on a datetime `field`.
+
+    The range is expressed as [start of `from`, start of the day after `to`) so the
+    database can use an index on the column instead of truncating every value.
+    """
+    lookups = {}
+    date_from = parse_date_param(params, 'from')
+    date_to = parse_date_param(params, 'to')
+    if date_from:
+        lookups[f'{field}__gte'] = timezone.make_aware(datetime.combine(date_from, time.min))
+    if date_to:
+        lookups[f'{field}__lt'] = timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min))
+    return lookups
+
+
+def is_shop_staff(user):
+    return user.role == 'Manager' or user.is_superuser == True or user.role == 'Salesman'
+
+
+def cached_for_collection(name, key, build):
+    """
+    Return `build()` cached for the current version of collection `name`.
+
+    Any change to the collection bumps its version, which moves the cache key, so
+    the value is recomputed at most once per change and a hit costs one lookup
+    of the version row.
+    """
+    version = CollectionVersion.objects.filter(name=name).values_list('version', flat=True).first() or 0
+    cache_key = f'inventory:{name}:{version}:{key}'
+    value = cache.get(cache_key)
+    if value is None:
+        value = build()
+        cache.set(cache_key, value, timeout=settings.REFERENCE_CACHE_TIMEOUT)
+    return value
+
+
+def conditional_collection(name):
+    """
+    Give a list view ETag / Last-Modified validators from the collection's version row.
+
+    The ETag is derived from the version and the full request path (so filters and
+    cursors get their own tags). When the client already holds the current one the
+    view answers 304 Not Modified without running the query or the serializer;
+    the version check is a single lookup on a unique index.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            version, updated_at = CollectionVersion.objects.filter(name=name).values_list('version', 'updated_at').first() or (0, None)
+            etag = '"%s"' % hashlib.md5(f"{name}:{version}:{request.get_full_path()}".encode()).hexdigest()
+            last_modified = int(updated_at.timestamp()) if updated_at else None
+
+            response = None
+            if is_shop_staff(request.user):
+                response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = method(self, request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+            else:
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+
+            response['ETag'] = etag
+            if last_modified:
+                response['Last-Modified'] = http_date(last_modified)
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
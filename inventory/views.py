@@ -1,9 +1,9 @@
 from rest_framework.views import APIView
 from django.db.models import Sum, Count
 from rest_framework.response import Response
-from rest_framework import status, permissions
-from django.db.models import F, Sum, ExpressionWrapper, DecimalField
-from .models import Product, Supplier, Order, OrderItem, Category, CustomerInfo, CompanyInfo, OrderLog, Report, ExpenseTypes, OtherExpenses, PurchaseExpense, PurchaseProduct
+from rest_framework import status, permissions, serializers
+from django.db.models import F, Sum, ExpressionWrapper, DecimalField, Prefetch
+from .models import Product, Supplier, Order, OrderItem, Category, CustomerInfo, CompanyInfo, OrderLog, Report, ExpenseTypes, OtherExpenses, PurchaseExpense, PurchaseProduct, StockMovement
 from .serializers import (
     ProductPostSerializer, 
     ProductGetSerializer, 
@@ -22,17 +22,34 @@ from .serializers import (
     OtherExpensesSerializer,
     OtherExpensesGetSerializer,
     PurchaseProductSerializer,
-    PurchaseExpenseSerializer
+    PurchaseExpenseSerializer,
+    StockMovementSerializer
 
 )
 import logging
+from datetime import timedelta
 
 logger = logging.getLogger(__name__)
 from django.core.exceptions import ValidationError
-from .utils import create_order_log
+from .utils import create_order_log, wants_pagination, get_page_size, keyset_paginate, iterate_in_chunks, date_range_lookups, parse_date_param, conditional_collection, cached_for_collection
+from .exports import stream_csv, stream_xlsx, XLSX_CONTENT_TYPE
+from .cache import cached_reference_list, reference_cache_stats
+from django.http import StreamingHttpResponse
+from .rollups import filter_sales_rollup, sales_series
+from .sync import parse_sync_params, build_change_feed
+from .imports import import_products
+from .adjustments import BulkAdjustmentSerializer, bulk_adjust_products
+from .sparse import sparse_fields, serialize_rows, limit_columns
+from .idempotency import idempotent
+from .audit import audit_outbox_lag
+from .orders import OrderBatchSerializer, create_orders_batch
+from .ledger import stock_at, local_midnight
+
+PRODUCT_ORDERINGS = ('id', '-id', 'name', '-name')
 
 class ProductListCreateAPIView(APIView):
     # permission_classes = (permissions.AllowAny,)
+    @conditional_collection('products')
     def get(self, request, format=None):
         try:
             user = request.user
@@ -41,10 +58,35 @@ class ProductListCreateAPIView(APIView):
                     {"error": "You are not authorized to retrive the Product."},
                     status=status.HTTP_403_FORBIDDEN
                 )
-            product = Product.objects.all()
-            # products = Product.objects.all().order_by('id')
-            serializer = ProductGetSerializer(product, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            # Join category and supplier in the same query instead of one lookup per row
+            product = Product.objects.select_related('category', 'supplier')
+            fields = sparse_fields(request)
+            if not wants_pagination(request):
+                try:
+                    data = serialize_rows(ProductGetSerializer, product, fields)
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                return Response(data, status=status.HTTP_200_OK)
+
+            ordering = request.query_params.get('ordering', 'id')
+            if ordering not in PRODUCT_ORDERINGS:
+                return Response(
+                    {"error": f"Ordering must be one of {', '.join(PRODUCT_ORDERINGS)}."},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            try:
+                # The cursor is built from the ordering column, so it must be loaded too
+                product = limit_columns(product, ProductGetSerializer(fields=fields), extra=(ordering.lstrip('-'),))
+                page, next_cursor = keyset_paginate(
+                    product,
+                    ordering=ordering,
+                    cursor=request.query_params.get('cursor'),
+                    page_size=get_page_size(request),
+                )
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            serializer = ProductGetSerializer(page, many=True, fields=fields)
+            return Response({"results": serializer.data, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
             
                       
         except KeyError as e:
@@ -78,6 +120,66 @@ class ProductListCreateAPIView(APIView):
             )
 
 
+class ProductImportAPIView(APIView):
+    def post(self, request, format=None):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True):
+                return Response(
+                    {"error": "You are not authorized to import Products."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            upload = request.FILES.get('file')
+            if upload is None:
+                return Response({"error": "Upload a .csv or .xlsx file as 'file'."}, status=status.HTTP_400_BAD_REQUEST)
+
+            supplier = None
+            supplier_id = request.data.get('supplier')
+            if supplier_id:
+                try:
+                    supplier = Supplier.objects.get(pk=supplier_id)
+                except (Supplier.DoesNotExist, ValueError):
+                    return Response({"error": "Supplier not found."}, status=status.HTTP_404_NOT_FOUND)
+
+            try:
+                result = import_products(upload, user_name=user.name, default_supplier=supplier)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(result, status=status.HTTP_200_OK)
+
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while Importing the Products.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class ProductBulkAdjustAPIView(APIView):
+    def post(self, request, format=None):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True):
+                return Response(
+                    {"error": "You are not authorized to update the Product."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            serializer = BulkAdjustmentSerializer(data=request.data)
+            if not serializer.is_valid():
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+            result, applied = bulk_adjust_products(serializer.validated_data, user_name=user.name)
+            if not applied:
+                result["error"] = "Some products would end up with a value the field cannot hold; nothing was changed."
+                return Response(result, status=status.HTTP_400_BAD_REQUEST)
+            return Response(result, status=status.HTTP_200_OK)
+
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while Updating the Products.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
 class ProductRetrieveUpdateDeleteAPIView(APIView):
     # permission_classes = (permissions.AllowAny,)
     def get(self, request, pk):
@@ -193,9 +295,10 @@ class SupplierListCreateAPIView(APIView):
                     status=status.HTTP_403_FORBIDDEN
                 )
             # print(user.role)
-            supplier = Supplier.objects.all()
-            serializer = SupplierSerializer(supplier, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)                            
+            supplier = cached_reference_list(
+                'suppliers', lambda: SupplierSerializer(Supplier.objects.all(), many=True).data
+            )
+            return Response(supplier, status=status.HTTP_200_OK)                            
         except KeyError as e:
             return Response(
                 {"error": f"An error occurred while Retriving the Supplier.  {str(e)}"},
@@ -335,6 +438,7 @@ class SupplierRetrieveUpdateDeleteAPIView(APIView):
 
 class CustomerListCreateAPIView(APIView):
     # permission_classes = (permissions.AllowAny,)
+    @conditional_collection('customers')
     def get(self, request, format=None):
         try:
             user = request.user
@@ -344,8 +448,11 @@ class CustomerListCreateAPIView(APIView):
                     status=status.HTTP_403_FORBIDDEN
                 ) 
             customer = CustomerInfo.objects.all()
-            serializer = CustomerInfoSerializer(customer, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)      
+            try:
+                data = serialize_rows(CustomerInfoSerializer, customer, sparse_fields(request))
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(data, status=status.HTTP_200_OK)      
         except KeyError as e:
             return Response(
                 {"error": f"An error occurred while Retriving the Customers.  {str(e)}"},
@@ -488,9 +595,10 @@ class CompanyListCreateAPIView(APIView):
                     {"error": "You are not authorized to retrive the Company."},
                     status=status.HTTP_403_FORBIDDEN
                 )
-            company = CompanyInfo.objects.all()
-            serializer = CompanyInfoSerializer(company, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            company = cached_reference_list(
+                'company', lambda: CompanyInfoSerializer(CompanyInfo.objects.all(), many=True).data
+            )
+            return Response(company, status=status.HTTP_200_OK)
             
                       
         except KeyError as e:
@@ -631,6 +739,7 @@ class CompanyRetrieveUpdateDeleteAPIView(APIView):
 
 class OrderListCreateAPIView(APIView):
     # permission_classes = (permissions.AllowAny,)
+    @conditional_collection('orders')
     def get(self, request, format=None):
         try:
             user = request.user
@@ -639,15 +748,46 @@ class OrderListCreateAPIView(APIView):
                     {"error": "You are not authorized to retrieve the Order."},
                     status=status.HTTP_403_FORBIDDEN
                 )               
-            order = Order.objects.all()
-            serializer = OrderGetSerializer(order, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)     
+            # Customer joined, items and their products fetched in one extra query for the whole page
+            order = Order.objects.select_related('customer').prefetch_related(
+                Prefetch('items', queryset=OrderItem.objects.select_related('product'))
+            )
+            try:
+                order = order.filter(**date_range_lookups(request.query_params, 'order_date'))
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            for field in ('status', 'customer', 'user'):
+                if request.query_params.get(field):
+                    order = order.filter(**{field: request.query_params[field]})
+            fields = sparse_fields(request)
+
+            if not wants_pagination(request):
+                try:
+                    data = serialize_rows(OrderGetSerializer, order, fields)
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                return Response(data, status=status.HTTP_200_OK)
+
+            # Newest first; every filter above has a (field, order_date) index to seek through
+            try:
+                order = limit_columns(order, OrderGetSerializer(fields=fields), extra=('order_date',))
+                page, next_cursor = keyset_paginate(
+                    order,
+                    ordering='-order_date',
+                    cursor=request.query_params.get('cursor'),
+                    page_size=get_page_size(request),
+                )
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            serializer = OrderGetSerializer(page, many=True, fields=fields)
+            return Response({"results": serializer.data, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
         except KeyError as e:
             return Response(
                 {"error": f"An error occurred while Retriving the Orders.  {str(e)}"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @idempotent('orders')
     def post(self, request, format=None):
         try:
             user = request.user
@@ -670,6 +810,45 @@ class OrderListCreateAPIView(APIView):
             )
 
 
+class OrderBatchAPIView(APIView):
+    @idempotent('orders-batch')
+    def post(self, request, format=None):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True or user.role == 'Salesman'):
+                return Response(
+                    {"error": "You are not authorized to create the Order."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            batch = OrderBatchSerializer(data=request.data)
+            if not batch.is_valid():
+                return Response(batch.errors, status=status.HTTP_400_BAD_REQUEST)
+
+            results = create_orders_batch(
+                OrderSerializer,
+                batch.validated_data['orders'],
+                context={"request": request},
+                all_or_nothing=batch.validated_data['all_or_nothing'],
+            )
+            created = sum(1 for result in results if result['status'] == 'created')
+            failed = sum(1 for result in results if result['status'] == 'error')
+            if not failed:
+                response_status = status.HTTP_201_CREATED
+            elif created:
+                response_status = status.HTTP_207_MULTI_STATUS
+            else:
+                response_status = status.HTTP_400_BAD_REQUEST
+            return Response(
+                {"created": created, "failed": failed, "results": results},
+                status=response_status
+            )
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while creating the Orders.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
 class OrderRetrieveUpdateDeleteAPIView(APIView):
     # permission_classes = (permissions.AllowAny,)
     def get(self, request, pk):
@@ -727,6 +906,9 @@ class OrderRetrieveUpdateDeleteAPIView(APIView):
             # Return the updated data as a response
             return Response({"message": f"Order Updated successfully."}, status=status.HTTP_200_OK)
 
+        except serializers.ValidationError as e:
+            # Stock shortages and expired holds found while applying the edit
+            return Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
         except KeyError as e:
             return Response(
                 {"error": f"An error occurred while updating the Order. {str(e)}"},
@@ -1026,9 +1208,10 @@ class CategoryListCreateAPIView(APIView):
                     status=status.HTTP_403_FORBIDDEN
                 )
             # category = Category.objects.all()
-            category = Category.objects.all().order_by('id')
-            serializer = CategorySerializer(category, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)              
+            category = cached_reference_list(
+                'categories', lambda: CategorySerializer(Category.objects.all().order_by('id'), many=True).data
+            )
+            return Response(category, status=status.HTTP_200_OK)              
                       
         except KeyError as e:
             return Response(
@@ -1166,6 +1349,61 @@ class CategoryRetrieveUpdateDeleteAPIView(APIView):
             )
 
 
+class ReferenceCacheStatsAPIView(APIView):
+    def get(self, request):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True):
+                return Response(
+                    {"error": "You are not authorized to retrive the Cache Statistics."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            return Response(reference_cache_stats(), status=status.HTTP_200_OK)
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while Retriving the Cache Statistics.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class AuditOutboxAPIView(APIView):
+    def get(self, request):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True):
+                return Response(
+                    {"error": "You are not authorized to retrive the Audit Lag."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            return Response(audit_outbox_lag(), status=status.HTTP_200_OK)
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while Retriving the Audit Lag.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class SyncAPIView(APIView):
+    def get(self, request):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True or user.role == 'Salesman'):
+                return Response(
+                    {"error": "You are not authorized to retrive the Changes."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            try:
+                since, limit = parse_sync_params(request.query_params)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(build_change_feed(since, limit), status=status.HTTP_200_OK)
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while Retriving the Changes.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
 class RetriveRevenueAPIView(APIView):
     def get(self, request): 
         try:
@@ -1176,8 +1414,18 @@ class RetriveRevenueAPIView(APIView):
                     status=status.HTTP_403_FORBIDDEN
                 ) 
 
-            # revenue = Order.objects.aggregate(total_revenue=Sum('total_amount'))        
-            revenue = OrderItem.objects.aggregate(total_revenue=Sum('price'))        
+            # Read from the daily rollup instead of scanning every OrderItem
+            try:
+                rows = filter_sales_rollup(request.query_params)
+                revenue = rows.aggregate(total_revenue=Sum('revenue'))
+                granularity = request.query_params.get('granularity')
+                if granularity:
+                    revenue['series'] = [
+                        {"period": row['period'], "revenue": row['total_revenue'], "quantity": row['total_quantity']}
+                        for row in sales_series(rows, granularity)
+                    ]
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
             return Response(revenue, status=status.HTTP_200_OK)         
         except KeyError as e:
             return Response(
@@ -1195,19 +1443,25 @@ class RetriveProfitAPIView(APIView):
                     {"error": "You are not authorized to retrive the Profit."},
                     status=status.HTTP_403_FORBIDDEN
                 )
-            # buying_price = Product.objects.aggregate(total_cost=Sum('buying_price'))
-
-            revenue = OrderItem.objects.aggregate(total_revenue=Sum('price')) 
-            cost = OrderItem.objects.aggregate(total_cost=Sum('cost')) 
-            # profit = OrderItem.objects.aggregate(total_profit=Diff('price' - 'cost'))
-            profit = OrderItem.objects.aggregate(
-                    total_profit=Sum(
-                        ExpressionWrapper(
-                            F('price') - F('cost'),
-                            output_field=DecimalField()
+            # Read from the daily rollup in a single aggregate instead of three full scans
+            try:
+                rows = filter_sales_rollup(request.query_params)
+                profit = rows.aggregate(
+                        total_profit=Sum(
+                            ExpressionWrapper(
+                                F('revenue') - F('cost'),
+                                output_field=DecimalField()
+                            )
                         )
                     )
-                )
+                granularity = request.query_params.get('granularity')
+                if granularity:
+                    profit['series'] = [
+                        {"period": row['period'], "revenue": row['total_revenue'], "cost": row['total_cost'], "profit": row['total_profit']}
+                        for row in sales_series(rows, granularity)
+                    ]
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
             return Response(profit, status=status.HTTP_200_OK)         
         except KeyError as e:
             return Response(
@@ -1225,9 +1479,30 @@ class OrderLogAPIView(APIView):
                     {"error": "You are not authorized to retrive the Receipt."},
                     status=status.HTTP_403_FORBIDDEN
                 )
-            logs = OrderLog.objects.all()
-            serializer = OrderLogSerializer(logs, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            try:
+                logs = OrderLog.objects.filter(**date_range_lookups(request.query_params, 'timestamp'))
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            for field in ('model_name', 'action', 'user'):
+                if request.query_params.get(field):
+                    logs = logs.filter(**{field: request.query_params[field]})
+
+            if not wants_pagination(request):
+                serializer = OrderLogSerializer(logs, many=True)
+                return Response(serializer.data, status=status.HTTP_200_OK)
+
+            # Newest first; every filter above has a (field, timestamp) index to seek through
+            try:
+                page, next_cursor = keyset_paginate(
+                    logs,
+                    ordering='-timestamp',
+                    cursor=request.query_params.get('cursor'),
+                    page_size=get_page_size(request),
+                )
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            serializer = OrderLogSerializer(page, many=True)
+            return Response({"results": serializer.data, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
 
         except KeyError as e:
             return Response(
@@ -1236,6 +1511,85 @@ class OrderLogAPIView(APIView):
             )
 
 
+class StockMovementListAPIView(APIView):
+    def get(self, request):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True):
+                return Response(
+                    {"error": "You are not authorized to view the stock ledger."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            try:
+                movements = StockMovement.objects.filter(**date_range_lookups(request.query_params, 'created_at'))
+                if request.query_params.get('product'):
+                    movements = movements.filter(product_id=int(request.query_params['product']))
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            if request.query_params.get('reason'):
+                movements = movements.filter(reason=request.query_params['reason'])
+            movements = movements.select_related('product')
+
+            if not wants_pagination(request):
+                serializer = StockMovementSerializer(movements.order_by('-created_at', '-id'), many=True)
+                return Response(serializer.data, status=status.HTTP_200_OK)
+
+            # Newest first, through the (product, created_at) or (created_at) index
+            try:
+                page, next_cursor = keyset_paginate(
+                    movements,
+                    ordering='-created_at',
+                    cursor=request.query_params.get('cursor'),
+                    page_size=get_page_size(request),
+                )
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            serializer = StockMovementSerializer(page, many=True)
+            return Response({"results": serializer.data, "next_cursor": next_cursor}, status=status.HTTP_200_OK)
+
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while Retriving the stock ledger.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class StockAtAPIView(APIView):
+    """Stock per product at the end of ?date=YYYY-MM-DD, optionally for ?product=1,2,3 only."""
+    def get(self, request):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True):
+                return Response(
+                    {"error": "You are not authorized to view the stock ledger."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            try:
+                day = parse_date_param(request.query_params, 'date')
+                if day is None:
+                    raise ValueError("'date' is required.")
+                product_ids = None
+                if request.query_params.get('product'):
+                    product_ids = [int(value) for value in request.query_params['product'].split(',') if value.strip()]
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            end_of_day = local_midnight(day + timedelta(days=1)) - timedelta(microseconds=1)
+            stock = stock_at(end_of_day, product_ids)
+            names = dict(Product.objects.filter(pk__in=stock).values_list('id', 'name'))
+            results = [
+                {"product": product_id, "name": names.get(product_id), "stock": quantity}
+                for product_id, quantity in sorted(stock.items())
+            ]
+            return Response({"date": day, "results": results}, status=status.HTTP_200_OK)
+
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while Retriving the stock.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
 class ExcelReportAPIView(APIView):
     def get(self, request):
         try:
@@ -1256,7 +1610,45 @@ class ExcelReportAPIView(APIView):
             )
 
 
+class ReportExportAPIView(APIView):
+    REPORT_COLUMNS = ['id', 'user', 'customer_name', 'customer_phone', 'customer_tin_number', 'order_date', 'product_name', 'product_price', 'quantity', 'price']
+
+    def get(self, request):
+        try:
+            user = request.user
+            if not (user.role == 'Manager' or user.is_superuser == True or user.role == 'Salesman'):
+                return Response(
+                    {"error": "You are not authorized to export the Report."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            file_type = request.query_params.get('type', 'csv')
+            if file_type not in ('csv', 'xlsx'):
+                return Response({"error": "type must be csv or xlsx."}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                report = Report.objects.filter(**date_range_lookups(request.query_params, 'order_date'))
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            if request.query_params.get('user'):
+                report = report.filter(user=request.query_params['user'])
+
+            # Rows are read in id-ordered chunks and written out as they arrive
+            rows = iterate_in_chunks(report.values_list(*self.REPORT_COLUMNS))
+            if file_type == 'xlsx':
+                response = StreamingHttpResponse(stream_xlsx(self.REPORT_COLUMNS, rows), content_type=XLSX_CONTENT_TYPE)
+            else:
+                response = StreamingHttpResponse(stream_csv(self.REPORT_COLUMNS, rows), content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="sales_report.{file_type}"'
+            return response
+
+        except KeyError as e:
+            return Response(
+                {"error": f"An error occurred while Exporting the Report.  {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
 class ListOutOFStockProductAPIView(APIView):
+    @conditional_collection('products')
     def get(self, request):
         try:
             user = request.user
@@ -1265,7 +1657,8 @@ class ListOutOFStockProductAPIView(APIView):
                     {"error": "You are not authorized to retrive the near Stock."},
                     status=status.HTTP_403_FORBIDDEN
                 )
-            out_of_stock_products = Product.objects.filter(stock__lte=3)
+            # Each product's own reorder point decides; the flag is indexed
+            out_of_stock_products = Product.objects.filter(is_low_stock=True).select_related('category', 'supplier').order_by('id')
             serializer = ProductGetSerializer(out_of_stock_products, many=True)
             return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -1285,7 +1678,9 @@ class CountNearExpirationDateProductAPIView(APIView):
                     {"error": "You are not authorized to retrive the Stock Shortage."},
                     status=status.HTTP_403_FORBIDDEN
                 )
-            out_of_stock_products = Product.objects.filter(stock__lte=3).aggregate(out_of_stock=Count('name'))
+            out_of_stock_products = cached_for_collection(
+                'products', 'low_stock_count', lambda: Product.objects.filter(is_low_stock=True).aggregate(out_of_stock=Count('id'))
+            )
             return Response(out_of_stock_products, status=status.HTTP_200_OK)
 
         except KeyError as e:
@@ -1306,9 +1701,10 @@ class ExpenseTypesListCreateAPIView(APIView):
                     {"error": "You are not authorized to retrive the Expense Types."},
                     status=status.HTTP_403_FORBIDDEN
                 )
-            expense_type = ExpenseTypes.objects.all().order_by('id')
-            serializer = ExpenseTypesSerializer(expense_type, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)              
+            expense_type = cached_reference_list(
+                'expense_types', lambda: ExpenseTypesSerializer(ExpenseTypes.objects.all().order_by('id'), many=True).data
+            )
+            return Response(expense_type, status=status.HTTP_200_OK)              
                       
         except KeyError as e:
             return Response(
@@ -1678,6 +2074,7 @@ class PurchaseExpenseListCreate(APIView):
         serializer = PurchaseExpenseSerializer(expenses, many=True)
         return Response(serializer.data)
 
+    @idempotent('purchase-expenses')
     def post(self, request):
         serializer = PurchaseExpenseSerializer(data=request.data)
         if serializer.is_valid():
@@ -16,6 +16,7 @@ from datetime import timedelta
 from rest_framework import response
 # import django_heroku
 from dotenv import load_dotenv
+from corsheaders.defaults import default_headers
 # import dj_database_url
 
  # Load environment variables from .env file
@@ -78,6 +79,10 @@ CORS_ALLOWED_ORIGINS = [
 
 CORS_ALLOW_ALL_ORIGINS = True 
 
+# Tablets send this header to make order and purchase submissions safe to retry
+CORS_ALLOW_HEADERS = (*default_headers, "idempotency-key")
+CORS_EXPOSE_HEADERS = ["Idempotent-Replayed"]
+
 
 ROOT_URLCONF = 'main_project.urls'
 
@@ -127,6 +132,23 @@ DATABASES = {
 # DATABASES['default'] = dj_database_url.parse(database_url)
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# The local-memory default is per process; deployments with several workers should
+# point CACHE_BACKEND/CACHE_LOCATION at a shared cache (e.g. Redis or Memcached) so
+# invalidations reach every worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv("CACHE_BACKEND", 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv("CACHE_LOCATION", 'tokiyo'),
+    }
+}
+
+# Seconds a cached reference list (categories, suppliers, ...) may live without being invalidated
+REFERENCE_CACHE_TIMEOUT = int(os.getenv("REFERENCE_CACHE_TIMEOUT", "86400"))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -215,6 +237,51 @@ SIMPLE_JWT = {
 }
 
 
+# Order log rows older than this many days are removed by `manage.py prune_order_logs`
+ORDER_LOG_RETENTION_DAYS = int(os.getenv("ORDER_LOG_RETENTION_DAYS", "365"))
+
+
+# "sync" writes order log and report rows inside the checkout transaction; "outbox" queues one
+# event per checkout instead, turned into those rows by `manage.py drain_audit_outbox`
+ORDER_AUDIT_MODE = os.getenv("ORDER_AUDIT_MODE", "sync")
+
+
+# Responses stored for an Idempotency-Key header are replayed for this long, then swept
+# by `manage.py sweep_idempotency_keys`
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+
+
+# Pending orders hold their stock this long; `manage.py release_expired_reservations`
+# then gives it back and marks the orders Expired
+STOCK_RESERVATION_TTL_HOURS = int(os.getenv("STOCK_RESERVATION_TTL_HOURS", "48"))
+
+
+# `manage.py take_stock_snapshots` sums the stock ledger into per-product snapshots this
+# many days apart, so a point-in-time stock query reads one snapshot and a short range
+STOCK_SNAPSHOT_INTERVAL_DAYS = int(os.getenv("STOCK_SNAPSHOT_INTERVAL_DAYS", "7"))
+
+
+# Cost of sales: "fifo" charges the oldest cost layers first, "average" the running weighted
+# average cost. Layers and averages are kept either way; after switching, `manage.py
+# recompute_costs` revalues past sales under the new method
+COSTING_METHOD = os.getenv("COSTING_METHOD", "fifo")
+
+
+# The sync feed only serves changes older than this, so a client's token never skips
+# past a journal insert that took a lower id but has not committed yet
+SYNC_SETTLE_SECONDS = int(os.getenv("SYNC_SETTLE_SECONDS", "5"))
+
+
+# Resized copies of uploaded product, logo and profile images, as the longest side in pixels
+IMAGE_DERIVATIVE_SIZES = {
+    'thumb': 160,
+    'small': 480,
+    'medium': 960,
+}
+IMAGE_DERIVATIVE_QUALITY = int(os.getenv("IMAGE_DERIVATIVE_QUALITY", "80"))
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv("IMAGE_DERIVATIVE_WORKERS", "2"))
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
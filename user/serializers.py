@@ -1,13 +1,20 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from inventory.images import ImageDerivativesField
+from inventory.sparse import SparseFieldsMixin
 User = get_user_model()
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    profile_image_derivatives = ImageDerivativesField(source='profile_image')
+
     class Meta:
         model = User
         # fields = ('email', 'name', 'role')
         fields = '__all__'
+        extra_kwargs = {
+            'password': {'write_only': True},  # Never send the password hash back
+        }
     
     def update(self, instance, validated_data):
         # Extract the password from the validated_data
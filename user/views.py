@@ -1,6 +1,7 @@
 from django.contrib.auth import get_user_model
 User = get_user_model()
 from .serializers import UserSerializer
+from inventory.sparse import sparse_fields, serialize_rows
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import permissions, status
@@ -33,8 +34,11 @@ class UserListCreateAPIView(APIView):
                 # Retrieve all users for non-managers and non-salesman
                 users = User.objects.all()
             # user = User.objects.all()
-            serializer = UserSerializer(users, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            try:
+                data = serialize_rows(UserSerializer, users, sparse_fields(request))
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(data, status=status.HTTP_200_OK)
                 
         except:
             return Response(